@@ -0,0 +1,320 @@
+import os, io, sys, csv, json, time, random, shutil, sqlite3, argparse, platform, tempfile, database, test_queryplans
+
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+
+sizedistributions = {
+    'small': lambda: random.randint(0, 64 * pow(2, 10)),
+    'mixed': lambda: min(int(random.lognormvariate(11, 2)), 64 * pow(2, 20)),
+    'large': lambda: random.randint(4 * pow(2, 20), 32 * pow(2, 20)),
+}
+
+class Dataset:
+    def __init__(self, root, hosts, dirs, files, dests, sizes, seed = 1):
+        self.root = root
+        self.dictionary = os.path.join(root, 'dictionary')
+        self.hosts = hosts
+        self.dirs = dirs
+        self.files = files
+        self.dests = dests
+        self.sizes = sizes
+        self.seed = seed
+        self.totalsize = 0
+        self.dbcount = 0
+
+    def generate(self):
+        random.seed(self.seed)
+        distribution = sizedistributions[self.sizes]
+        hosts = [(hostid, 'host%d' % hostid) for hostid in range(1, self.hosts + 1)]
+        dirs = []
+        files = []
+        for dirid in range(1, self.dirs + 1):
+            hostid = (dirid - 1) % self.hosts + 1
+            location = os.path.join(self.root, 'src', 'host%d' % hostid)
+            dirpath = os.path.join(location, 'dir%04d' % dirid)
+            os.makedirs(dirpath)
+            dirsize = 0
+            for index in range(self.files * dirid // self.dirs - self.files * (dirid - 1) // self.dirs):
+                filename = 'f%06d' % index
+                size = distribution()
+                with open(os.path.join(dirpath, filename + '.bin'), 'wb') as outfile:
+                    outfile.write(random.randbytes(size) if hasattr(random, 'randbytes') else os.urandom(size))
+                files.append((len(files) + 1, filename, '.bin', size, dirpath))
+                dirsize += size
+            dirs.append((dirid, 'dir%04d' % dirid, dirsize, location, hostid))
+            self.totalsize += dirsize
+        dests = []
+        for destid in range(1, self.dests + 1):
+            diskpath = os.path.join(self.root, 'dest%d' % destid)
+            os.makedirs(diskpath)
+            dests.append((destid, 'bench', 'SN%04d' % destid, 'synthetic', self.totalsize, diskpath))
+        os.makedirs(self.dictionary)
+        self.writecsv('StorageHost.csv', ('HostID', 'HostAddr'), hosts)
+        self.writecsv('StorageDir.csv', ('DirID', 'DirName', 'DirSize', 'Location', 'HostID'), dirs)
+        self.writecsv('StorageFile.csv', ('FileID', 'FileName', 'ExtName', 'FileSize', 'Location'), files)
+        self.writecsv('Destination.csv', ('DestID', 'DiskBatch', 'DiskSN', 'DiskModel', 'DiskCapacity', 'DiskPath'),
+                      dests)
+
+    def writecsv(self, name, header, rows):
+        with open(os.path.join(self.dictionary, name), 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    def csvpath(self, name):
+        return os.path.join(self.dictionary, name)
+
+    def newdatabase(self):
+        self.dbcount += 1
+        path = os.path.join(self.root, 'db', 'bench%03d.db' % self.dbcount)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def resetdests(self):
+        for destid in range(1, self.dests + 1):
+            diskpath = os.path.join(self.root, 'dest%d' % destid)
+            shutil.rmtree(diskpath)
+            os.makedirs(diskpath)
+
+    def build(self, path, bulk = True):
+        manager = database.TaskManager(database.Database(path))
+        manager.upgrade_database()
+        with redirect_stdout(io.StringIO()):
+            manager.tablehost.append(self.csvpath('StorageHost.csv'))
+            manager.tabledir.append(self.csvpath('StorageDir.csv'))
+            if bulk:
+                manager.tablefile.bulkappend(self.csvpath('StorageFile.csv'))
+            else:
+                manager.tablefile.append(self.csvpath('StorageFile.csv'))
+            manager.tabledest.append(self.csvpath('Destination.csv'))
+        manager.activateall(database.ActiveState.active)
+        manager.tabledir.update_filessize()
+        return manager
+
+def result(name, elapsed, count, unit, **extra):
+    elapsed = max(elapsed, 1e-9)
+    record = {'name': name, 'seconds': round(elapsed, 6), 'count': count,
+              'unit': unit, 'rate': round(count / elapsed, 3)}
+    record.update(extra)
+    print('%-32s %10.3fs %10d %-6s %12.1f/s' % (name, elapsed, count, unit, record['rate']), file=sys.stderr)
+    return record
+
+def bench_import(dataset):
+    results = []
+    for name, bulk in (('import.append', False), ('import.bulkappend', True)):
+        path = dataset.newdatabase()
+        manager = database.TaskManager(database.Database(path))
+        manager.upgrade_database()
+        with redirect_stdout(io.StringIO()):
+            manager.tablehost.append(dataset.csvpath('StorageHost.csv'))
+            manager.tabledir.append(dataset.csvpath('StorageDir.csv'))
+            starttime = time.perf_counter()
+            if bulk:
+                manager.tablefile.bulkappend(dataset.csvpath('StorageFile.csv'))
+            else:
+                manager.tablefile.append(dataset.csvpath('StorageFile.csv'))
+            elapsed = time.perf_counter() - starttime
+        results.append(result(name, elapsed, manager.tablefile.countall(), 'rows'))
+    return results
+
+def claimworker(path, idlelimit = 20):
+    manager = database.TaskManager(database.Database(path))
+    claimed = []
+    waits = []
+    idle = 0
+    started = finished = time.time()
+    while idle < idlelimit:
+        starttime = time.perf_counter()
+        task = manager.requesttask()
+        waits.append(time.perf_counter() - starttime)
+        if not task:
+            idle += 1
+            time.sleep(0.01)
+            continue
+        idle = 0
+        claimed.append(task['DirID'])
+        manager.updatecopystate(task['TaskID'], database.CopyState.finished)
+        finished = time.time()
+    return claimed, waits, started, finished
+
+def bench_claim(dataset, workers):
+    results = []
+    for count in workers:
+        path = dataset.newdatabase()
+        dataset.build(path)
+        with get_context('spawn').Pool(count) as pool:
+            outcomes = pool.starmap(claimworker, [(path, )] * count)
+        # leave out the process start up and the idle polls after the last claim
+        elapsed = max(outcome[3] for outcome in outcomes) - min(outcome[2] for outcome in outcomes)
+        claimed = [dirid for outcome in outcomes for dirid in outcome[0]]
+        waits = sorted(wait for outcome in outcomes for wait in outcome[1])
+        results.append(result('claim.tasks.%dworkers' % count, elapsed, len(claimed), 'tasks',
+                              workers=count, duplicates=len(claimed) - len(set(claimed)),
+                              p50=round(waits[len(waits) // 2], 6) if waits else None,
+                              p99=round(waits[len(waits) * 99 // 100], 6) if waits else None))
+    return results
+
+def bench_fileclaim(dataset, batchsize):
+    path = dataset.newdatabase()
+    manager = dataset.build(path)
+    tablefile = manager.tablefile
+    dirids = [dirid for dirid in range(1, dataset.dirs + 1)]
+    results = []
+
+    starttime = time.perf_counter()
+    count = 0
+    for dirid in dirids:
+        while True:
+            file = tablefile.getfilefrom(dirid, database.CopyState.idle, pow(2, 62))
+            if not file:
+                break
+            tablefile.updatecopystate(file['FileID'], 1, database.CopyState.busy)
+            tablefile.updatecopystate(file['FileID'], 1, database.CopyState.finished)
+            count += 1
+    results.append(result('fileclaim.single', time.perf_counter() - starttime, count, 'files'))
+
+    tablefile._zerocopystate()
+    starttime = time.perf_counter()
+    count = 0
+    for dirid in dirids:
+        while True:
+            files = tablefile.claimfiles(dirid, 1, database.CopyState.idle, batchsize, pow(2, 62))
+            if not files:
+                break
+            tablefile.completefiles(1, [(file['FileID'], database.CopyState.finished, None, None)
+                                        for file in files])
+            count += len(files)
+    results.append(result('fileclaim.batch%d' % batchsize, time.perf_counter() - starttime, count, 'files',
+                          batchsize=batchsize))
+    return results
+
+def bench_copy(dataset, modes):
+    # copyfiles opens its default catalog at ..\db\sqlite3 on import, keep that inside the dataset
+    os.makedirs(os.path.join(dataset.root, 'db', 'sqlite3'), exist_ok=True)
+    os.makedirs(os.path.join(dataset.root, 'bin'), exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(os.path.join(dataset.root, 'bin'))
+    try:
+        import copyfiles
+    finally:
+        os.chdir(cwd)
+    copyfiles.logdir = os.path.join(dataset.root, 'log')
+    results = []
+    for mode in modes:
+        dataset.resetdests()
+        path = dataset.newdatabase()
+        dataset.build(path)
+        manager = copyfiles.opendatabase(path)
+        copyfiles.pipeline = mode == 'pipeline'
+        count = 0
+        starttime = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            while True:
+                task = manager.requesttask()
+                if not task:
+                    break
+                copyfiles.copyfiles(task['DestID'], task['DirID'])
+                manager.updatecopystate(task['TaskID'], database.CopyState.finished)
+                count += 1
+            copyfiles.flushlogs()
+        elapsed = time.perf_counter() - starttime
+        copied = manager.tablefile.getcopied()
+        results.append(result('copy.' + mode, elapsed, sum(file['FileSize'] for file in copied), 'bytes',
+                              files=len(copied), tasks=count,
+                              mibps=round(sum(file['FileSize'] for file in copied) / pow(2, 20) / max(elapsed, 1e-9), 3)))
+    return results
+
+def bench_plans(dataset):
+    manager = dataset.build(dataset.newdatabase())
+    starttime = time.perf_counter()
+    scans = test_queryplans.fullscans(manager)
+    for name, detail in scans:
+        print('%s: %s' % (name, detail), file=sys.stderr)
+    return [result('plans.fullscans', time.perf_counter() - starttime, len(scans), 'scans',
+                   scans=['%s: %s' % scan for scan in scans])]
+
+def compare(baseline, current, threshold):
+    previous = {record['name']: record for record in baseline['results']}
+    regressions = []
+    print('Name,BaselineRate,CurrentRate,Change', file=sys.stderr)
+    for record in current['results']:
+        if record['name'] not in previous:
+            continue
+        before = previous[record['name']]['rate']
+        change = (record['rate'] - before) / before if before else 0
+        print('%s,%s,%s,%+.1f%%' % (record['name'], before, record['rate'], change * 100), file=sys.stderr)
+        if change < -threshold:
+            regressions.append(record['name'])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', default=['import', 'claim', 'fileclaim', 'copy', 'plans'],
+                        help='any of import, claim, fileclaim, copy, plans')
+    parser.add_argument('--hosts', type=int, default=2)
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--dests', type=int, default=2)
+    parser.add_argument('--sizes', choices=sorted(sizedistributions), default='small')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--batchsize', type=int, default=64)
+    parser.add_argument('--modes', nargs='+', choices=['plain', 'pipeline'], default=['plain', 'pipeline'])
+    parser.add_argument('--workdir', help='keep the dataset in this directory instead of a temporary one')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file')
+    parser.add_argument('-c', '--compare', help='compare the results against a previous JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix='offlinebackup-bench-')
+    dataset = Dataset(os.path.join(root, 'dataset'), args.hosts, args.dirs, args.files, args.dests,
+                      args.sizes, args.seed)
+    try:
+        starttime = time.perf_counter()
+        dataset.generate()
+        print('generated %d files, %d bytes in %.1fs'
+              % (args.files, dataset.totalsize, time.perf_counter() - starttime), file=sys.stderr)
+        results = []
+        for name in args.benchmarks:
+            if name == 'import':
+                results.extend(bench_import(dataset))
+            elif name == 'claim':
+                results.extend(bench_claim(dataset, args.workers))
+            elif name == 'fileclaim':
+                results.extend(bench_fileclaim(dataset, args.batchsize))
+            elif name == 'copy':
+                results.extend(bench_copy(dataset, args.modes))
+            elif name == 'plans':
+                results.extend(bench_plans(dataset))
+            else:
+                parser.error('unknown benchmark: ' + name)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'parameters': {'hosts': args.hosts, 'dirs': args.dirs, 'files': args.files,
+                             'dests': args.dests, 'sizes': args.sizes, 'seed': args.seed,
+                             'totalsize': dataset.totalsize},
+              'results': results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text + '\n')
+    else:
+        print(text)
+    # a hot query that falls back to a full scan fails the run with or without a baseline
+    regressions = [record['name'] for record in results if record.get('scans')]
+    if args.compare:
+        with open(args.compare) as infile:
+            regressions.extend(compare(json.load(infile), report, args.threshold))
+    if regressions:
+        print('regressions: ' + ', '.join(regressions), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,44 @@
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+blocksize = 4 * pow(2, 20)
+
+def newhash(algo):
+    if algo == 'xxhash':
+        if xxhash is None:
+            raise ValueError('xxhash is not installed')
+        return xxhash.xxh3_128()
+    return hashlib.new(algo)
+
+def updatehash(digest, path, length = None, bucket = None, offset = 0):
+    with open(path, 'rb') as infile:
+        infile.seek(offset)
+        while length is None or length > 0:
+            data = infile.read(blocksize if length is None else min(blocksize, length))
+            if not data:
+                break
+            if bucket:
+                bucket.consume(len(data))
+            digest.update(data)
+            if length is not None:
+                length -= len(data)
+    return digest
+
+def hashfile(path, algo, bucket = None, offset = 0, length = None):
+    return updatehash(newhash(algo), path, length, bucket, offset).hexdigest()
+
+def partialhash(path, algo, length = 65536):
+    digest = newhash(algo)
+    with open(path, 'rb') as infile:
+        size = infile.seek(0, 2)
+        digest.update(str(size).encode())
+        infile.seek(0)
+        digest.update(infile.read(length))
+        if size > length:
+            infile.seek(max(length, size - length))
+            digest.update(infile.read(length))
+    return digest.hexdigest()
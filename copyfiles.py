@@ -1,80 +1,809 @@
-import shutil, os, time, database
+import shutil, os, io, time, json, struct, atexit, random, errno, sqlite3, threading, queue, tarfile, checksum, metrics, database
 
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
 from pathlib import PurePath
-from shutil import disk_usage
 
-db = database.Database()
-conn = db.connection
-cursor = conn.cursor()
-manager = database.TaskManager(db)
-tablehost = database.TableHost(db)
-tabledir = database.TableDir(db)
-tablefile = database.TableFile(db)
-tabledest = database.TableDest(db)
-tabletask = database.TableTask(db)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def opendatabase(path = '..\\db\\sqlite3\\media.db'):
+    global db, conn, cursor, manager, tablehost, tabledir, tablefile, tabledest, tabletask, tablepack
+    db = database.Database(path)
+    conn = db.connection
+    cursor = conn.cursor()
+    manager = database.TaskManager(db)
+    tablehost = manager.tablehost
+    tabledir = manager.tabledir
+    tablefile = manager.tablefile
+    tabledest = manager.tabledest
+    tabletask = manager.tabletask
+    tablepack = manager.tablepack
+    return manager
+
+opendatabase()
+
+defaultworkers = 4
+destworkers = {}
+hostworkers = {}
+batchsize = 64
+mindelay = 1
+maxdelay = 60
+chunksize = 64 * pow(2, 20)
+verifysize = pow(2, 20)
+hashalgo = 'blake2b'
+verify = False
+verifyworkers = 2
+verifyrate = 50 * pow(2, 20)
+verifier = None
+pipeline = False
+readchunksize = 8 * pow(2, 20)
+buffermemory = 256 * pow(2, 20)
+packthreshold = pow(2, 20)
+packsize = pow(2, 30)
+metricsfile = None
+metricsport = None
+metricsinterval = 15
+heartbeatinterval = 20
+copyorder = 'locality'
+logdir = os.path.join('..', 'log')
+logbuffersize = 1000
+loginterval = 5
+logmaxsize = 64 * pow(2, 20)
+logbackups = 5
+logwriters = {}
+local = threading.local()
 
 
 def run():
+    manager.upgrade_database()
+    if metricsfile:
+        metrics.registry.startflusher(metricsfile, metricsinterval)
+    if metricsport:
+        metrics.registry.serve(metricsport)
+    delay = mindelay
     while True:
+        stamp = db.wakestamp()
         task = manager.requesttask()
         if task:
             try:
                 copyfiles(task['DestID'], task['DirID'])
             except OSError as why:
                 print(why)
-                manager.updatecopystate(task['TaskID'], database.CopyState.idle)
+                getlogwriter(task['DestID']).flush()
+                manager.updatecopystate(task['TaskID'], database.CopyState.idle, manager.workerid)
+                manager.capacity.invalidate(task['DestID'])
+                stamp = db.wakestamp()
             else:
-                manager.updatecopystate(task['TaskID'], database.CopyState.finished)
+                if not manager.updatecopystate(task['TaskID'], database.CopyState.finished, manager.workerid):
+                    print('Task %d was reclaimed by another worker.' % task['TaskID'])
+                manager.capacity.invalidate(task['DestID'])
+                delay = mindelay
+                continue
         else:
             print('The process is idle.')
 
-        time.sleep(10)
+        if db.wait(stamp, delay / 2 + random.uniform(0, delay / 2)):
+            delay = mindelay
+        else:
+            delay = min(delay * 2, maxdelay)
 
 def getfilepath(file):
     return str(PurePath(file['Location']).joinpath(file['FileName'] + file['ExtName']))
 
-def log(destid, dirname, filename, extname, srcfilepath):
-    destid = str(destid)
-    logname = '..\\log\\' + destid + '.log'
-    with open(logname, 'a') as logfile:
-      logfile.write(','.join((destid, dirname, filename, extname, srcfilepath)) + '\n')
-        
+class LogWriter:
+    def __init__(self, destid):
+        self.path = os.path.join(logdir, str(destid) + '.log')
+        self.lines = []
+        self.flushtime = time.monotonic()
+
+    def write(self, record):
+        self.lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+        if len(self.lines) >= logbuffersize or time.monotonic() - self.flushtime >= loginterval:
+            self.flush()
+
+    def flush(self):
+        self.flushtime = time.monotonic()
+        if not self.lines:
+            return
+        os.makedirs(logdir, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as logfile:
+            logfile.writelines(self.lines)
+            size = logfile.tell()
+        self.lines = []
+        if size >= logmaxsize:
+            self.rotate()
+
+    def rotate(self):
+        for index in range(logbackups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, index)):
+                os.replace('%s.%d' % (self.path, index), '%s.%d' % (self.path, index + 1))
+        os.replace(self.path, self.path + '.1')
+
+def getlogwriter(destid):
+    logwriter = logwriters.get(destid)
+    if logwriter is None:
+        logwriter = logwriters[destid] = LogWriter(destid)
+    return logwriter
+
+@atexit.register
+def flushlogs():
+    for logwriter in logwriters.values():
+        logwriter.flush()
+
+def log(destid, directory, file, srcfilepath, destfilepath, duration = None, filehash = None,
+        copystate = database.CopyState.finished, copystatus = None):
+    getlogwriter(destid).write({'Time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                'DestID': destid,
+                                'DirID': directory['DirID'],
+                                'DirName': directory['DirName'],
+                                'FileID': file['FileID'],
+                                'FileName': file['FileName'],
+                                'ExtName': file['ExtName'],
+                                'Source': srcfilepath,
+                                'Destination': destfilepath,
+                                'FileSize': file['FileSize'],
+                                'Duration': None if duration is None else round(duration, 6),
+                                'HashAlgo': hashalgo if filehash else None,
+                                'FileHash': filehash,
+                                'CopyState': int(copystate),
+                                'CopyStatus': copystatus})
+
+def getrate(host, dest, hoststreams = 1, deststreams = 1):
+    # Bandwidth is the cap of the whole host or disk, shared equally by the tasks busy on it now
+    rates = [limit['Bandwidth'] / max(streams or 1, 1)
+             for limit, streams in ((host, hoststreams), (dest, deststreams)) if limit and limit['Bandwidth']]
+    return min(rates) if rates else None
+
+def getbucket(host, dest, hoststreams = 1, deststreams = 1):
+    rate = getrate(host, dest, hoststreams, deststreams)
+    if not rate:
+        return None
+    return TokenBucket(rate)
+
+def getworkers(destid, hostid):
+    return max(1, min(destworkers.get(destid, defaultworkers),
+                      hostworkers.get(hostid, defaultworkers)))
+
 def copyfiles(destid, dirid):
+    # the lease runs from the claim, so it is kept alive through the preparation as well
+    with Heartbeat(db.path, heartbeatinterval, dirid) as heartbeat:
+        copydir(destid, dirid, heartbeat)
+
+def copydir(destid, dirid, heartbeat = None):
     dest = tabledest.getdest(destid)
     directory = tabledir.getdir(dirid)
     srcdirpath = str(PurePath(directory['Location']).joinpath(directory['DirName']))
     destdirpath = str(PurePath(dest['DiskPath']).joinpath(directory['DirName']))
+    # an unmounted disk would otherwise be recreated as an empty path on the local disk
+    if not os.path.isdir(dest['DiskPath']):
+        raise OSError('No such destination disk: ' + dest['DiskPath'])
     makedirs(destdirpath)
-    while True:
-        if not (os.path.exists(srcdirpath) and os.path.exists(destdirpath)):
-            raise OSError('No such direcory') 
-            
-        freeusage = disk_usage(destdirpath).free - pow(2,30)
-        file = tablefile.getfilefrom(dirid, database.CopyState.idle, freeusage)
-        if file:
-            srcfilepath = getfilepath(file)
-            destfilepath = str(PurePath(destdirpath).joinpath(file['FileName'] + file['ExtName']))
+    workers = getworkers(destid, directory['HostID'])
+    host = tablehost.gethost(directory['HostID'])
+    bucket = getbucket(host, dest, *manager.getstreams(directory['HostID'], destid))
+    if heartbeat and bucket:
+        heartbeat.throttle(bucket, host, dest)
+    labels = {'worker': metrics.workerid, 'host': directory['HostID'], 'dest': destid}
+    tablefile.resetfailed(dirid)
+    if copyorder and tablefile.countunordered(dirid):
+        orderfiles(dirid, copyorder)
+    # files in flight, claimed again as soon as no more than one per worker is left
+    window = max(batchsize, workers * 2)
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+         (Pipeline(executor, buffermemory, labels) if pipeline else nullcontext()) as copier, \
+         (Packer(dest['DiskPath'], directory['DirName']) if directory['PackMode'] else nullcontext()) as packer:
+        futures = {}
+        results = []
+        packs = []
+        packed = set()
+        verifications = []
+        written = 0
+        claiming = True
+
+        def checklease():
+            if heartbeat and not heartbeat.alive():
+                raise OSError('The lease of DirID %d was lost' % dirid)
+
+        def record():
+            nonlocal written
+            checklease()
+            if packs:
+                packer.flush()
+            db.begin('immediate')
             try:
-                copyfile(srcfilepath, destfilepath)
-            except OSError as why:
-                print(why)
-                tablefile.updatecopystate(file['FileID'], destid, database.CopyState.failed, str(why))
-                os.remove(destfilepath)
+                tablefile.completefiles(destid, results, hashalgo, manager.workerid)
+                tablepack.appendpacks(packs)
+            except:
+                db.rollback()
+                raise
             else:
-                tablefile.updatecopystate(file['FileID'], destid, database.CopyState.finished)
-                log(destid, directory['DirName'], file['FileName'], file['ExtName'], srcfilepath)
-        else:
-            tabledir.updatecopystate(dirid, database.CopyState.finished)
-            break;
+                db.commit()
+            manager.capacity.consume(destid, written)
+            # only after the files are recorded finished, or a quick mismatch gets overwritten
+            for verification in verifications:
+                getverifier().submit(*verification)
+            results.clear()
+            packs.clear()
+            verifications.clear()
+            written = 0
+
+        try:
+            while claiming or futures:
+                checklease()
+                if claiming and len(futures) <= workers:
+                    if not (os.path.exists(srcdirpath) and os.path.exists(destdirpath)):
+                        raise OSError('No such direcory') 
+                    if results:
+                        record()
+                    freeusage = manager.capacity.available(dest)
+                    files = tablefile.claimfiles(dirid, destid, database.CopyState.idle, window - len(futures),
+                                                 freeusage, manager.workerid, manager.leaseexpiry())
+                    if files is None:
+                        if heartbeat:
+                            heartbeat.lost.set()
+                        raise OSError('The lease of DirID %d was lost' % dirid)
+                    metrics.registry.set('offlinebackup_idle_files', tablefile.countidle(dirid), dir=dirid)
+                    claiming = bool(files)
+                    for file in files:
+                        srcfilepath = getfilepath(file)
+                        destfilepath = str(PurePath(destdirpath).joinpath(file.FileName + file.ExtName))
+                        copyargs = (srcfilepath, destfilepath, file.FileID, file.CopyOffset or 0, hashalgo, bucket)
+                        primary = getprimary(file)
+                        if primary and primary['DestID'] != destid:
+                            results.append((file.FileID, database.CopyState.finished,
+                                            'Duplicate of FileID %d on DestID %d' % (primary['FileID'], primary['DestID']),
+                                            primary['FileHash'] if primary['HashAlgo'] == hashalgo else None))
+                            log(destid, directory, file, srcfilepath, getdestfilepath(primary), 0,
+                                results[-1][3], copystatus=results[-1][2])
+                            continue
+                        if primary:
+                            future = executor.submit(measured, labels, file.FileSize,
+                                                     duplicatefile, getdestfilepath(primary),
+                                                     primary['FileHash'] if primary['HashAlgo'] == hashalgo else None,
+                                                     *copyargs)
+                        elif packer and file.FileSize < packthreshold:
+                            future = executor.submit(measured, labels, file.FileSize, readsmallfile, srcfilepath, bucket)
+                            packed.add(future)
+                        elif copier:
+                            future = copier.submit(*copyargs)
+                        else:
+                            future = executor.submit(measured, labels, file.FileSize, copyfile, *copyargs)
+                        futures[future] = (file, srcfilepath, destfilepath)
+                    if not futures:
+                        continue
+                done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # left in futures until handled, so an interrupted file goes back to idle
+                    file, srcfilepath, destfilepath = futures[future]
+                    try:
+                        filehash, duration = future.result()
+                        verification = (file.FileID, destfilepath, hashalgo, filehash)
+                        if future in packed:
+                            packed.discard(future)
+                            container, offset, filehash = packer.add(file, filehash)
+                            packs.append((file.FileID, destid, container, offset, file.FileSize))
+                            destfilepath = os.path.join(dest['DiskPath'], container)
+                            verification = (file.FileID, destfilepath, hashalgo, filehash, offset, file.FileSize)
+                    except OSError as why:
+                        print(why)
+                        results.append((file.FileID, database.CopyState.failed, str(why), None))
+                        log(destid, directory, file, srcfilepath, destfilepath,
+                            copystate=database.CopyState.failed, copystatus=str(why))
+                    else:
+                        results.append((file.FileID, database.CopyState.finished, None, filehash))
+                        written += file.FileSize - (file.CopyOffset or 0)
+                        if verify and filehash:
+                            verifications.append(verification)
+                        log(destid, directory, file, srcfilepath, destfilepath, duration, filehash)
+                    del futures[future]
+                if len(results) >= batchsize:
+                    record()
+        except:
+            for future in futures:
+                future.cancel()
+            if heartbeat and not heartbeat.alive():
+                # the files may be another worker's by now, nothing of this run is recorded
+                results.clear()
+                packs.clear()
+                verifications.clear()
+            else:
+                results.extend((file.FileID, database.CopyState.idle, None, None)
+                               for file, srcfilepath, destfilepath in futures.values())
+            raise
+        finally:
+            if results or packs:
+                record()
+    tabledir.updatecopystate(dirid, database.CopyState.finished)
+    getlogwriter(destid).flush()
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_DELALLOC = 0x4
+
+def physicaloffset(path):
+    # first extent of the file from the FIEMAP ioctl (Linux), None if the filesystem can't tell
+    if fcntl is None or not hasattr(fcntl, 'ioctl'):
+        return None
+    request = bytearray(32 + 56)
+    struct.pack_into('=QQLLLL', request, 0, 0, pow(2, 64) - 1, 0, 0, 1, 0)
+    try:
+        with open(path, 'rb') as infile:
+            fcntl.ioctl(infile.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    if not struct.unpack_from('=L', request, 20)[0]:
+        return None
+    # delayed allocation or unknown location, the physical offset means nothing yet
+    if struct.unpack_from('=L', request, 72)[0] & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC):
+        return None
+    return struct.unpack_from('=Q', request, 40)[0]
+
+def localitykey(path, mode):
+    try:
+        if mode == 'locality':
+            offset = physicaloffset(path)
+            if offset is not None:
+                return (0, offset)
+            return (1, os.stat(path).st_ino)
+    except OSError:
+        pass
+    return (2, 0)
+
+def orderfiles(dirid, mode = 'locality'):
+    files = [file for file in tablefile.getfilesof(dirid) if file['ActiveState'] == database.ActiveState.active]
+    paths = [getfilepath(file) for file in files]
+    if mode == 'path':
+        keys = [(2, 0)] * len(files)
+    else:
+        with ThreadPoolExecutor(max_workers=defaultworkers) as executor:
+            keys = list(executor.map(localitykey, paths, [mode] * len(paths)))
+    order = sorted(range(len(files)), key=lambda index: (keys[index], paths[index]))
+    tablefile.setcopyorder([(position, files[index]['FileID']) for position, index in enumerate(order)])
+
+def measured(labels, size, func, *args):
+    starttime = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - starttime
+    recordfile(labels, size, elapsed)
+    return result, elapsed
+
+def recordfile(labels, size, elapsed):
+    metrics.registry.inc('offlinebackup_copied_bytes_total', size, **labels)
+    metrics.registry.inc('offlinebackup_copied_files_total', 1, **labels)
+    metrics.registry.observe('offlinebackup_file_copy_seconds', elapsed, **labels)
+
+def getprimary(file):
+    if not file['DupOf']:
+        return None
+    primary = tablefile.getfile(file['DupOf'])
+    # a duplicate entry has no data of its own, the link goes to the copy it points at
+    if primary and primary['DupOf'] and (primary['CopyStatus'] or '').startswith('Duplicate of'):
+        primary = tablefile.getfile(primary['DupOf'])
+    if primary and primary['CopyState'] == database.CopyState.finished and primary['DestID']:
+        return primary
+    return None
+
+def getdestfilepath(file):
+    dest = tabledest.getdest(file['DestID'])
+    directory = tabledir.getdir(file['DirID'])
+    return str(PurePath(dest['DiskPath']).joinpath(directory['DirName'], file['FileName'] + file['ExtName']))
+
+def duplicatefile(primarypath, filehash, *copyargs):
+    srcfilepath, destfilepath = copyargs[:2]
+    try:
+        if os.path.exists(destfilepath):
+            os.remove(destfilepath)
+        os.link(primarypath, destfilepath)
+    except OSError:
+        return copyfile(*copyargs)
+    print(destfilepath)
+    return filehash
+
+class Packer:
+    def __init__(self, diskpath, dirname):
+        self.diskpath = diskpath
+        self.dirname = dirname
+        self.tar = None
+        self.container = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        index = 0
+        while True:
+            index += 1
+            container = str(PurePath(self.dirname).joinpath('pack-%04d.tar' % index))
+            if not os.path.exists(os.path.join(self.diskpath, container)):
+                break
+        print(os.path.join(self.diskpath, container))
+        self.container = container
+        self.tar = tarfile.open(os.path.join(self.diskpath, container), 'w', format=tarfile.PAX_FORMAT)
+
+    def add(self, file, content):
+        data, filestat = content
+        if self.tar and self.tar.offset >= packsize:
+            self.close()
+        if not self.tar:
+            self.open()
+        tarinfo = tarfile.TarInfo(file['FileName'] + file['ExtName'])
+        tarinfo.size = len(data)
+        tarinfo.mtime = filestat.st_mtime
+        offset = self.tar.offset + len(tarinfo.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(tarinfo, io.BytesIO(data))
+        self.tar.members.clear()
+        filehash = None
+        if hashalgo:
+            digest = checksum.newhash(hashalgo)
+            digest.update(data)
+            filehash = digest.hexdigest()
+        return self.container, offset, filehash
+
+    def flush(self):
+        if self.tar:
+            self.tar.fileobj.flush()
+            os.fsync(self.tar.fileobj.fileno())
+
+    def close(self):
+        if self.tar:
+            self.tar.close()
+            self.tar = None
+
+def readsmallfile(srcfilepath, bucket = None):
+    with open(srcfilepath, 'rb') as src:
+        data = src.read()
+        if bucket:
+            bucket.consume(len(data))
+        return data, os.fstat(src.fileno())
 
 def makedirs(dirpath):
     print(dirpath)
     if not os.path.exists(dirpath):
         os.makedirs(dirpath)
     
-def copyfile(srcfilepath, destfilepath):
+class Heartbeat:
+    def __init__(self, path, interval, dirid):
+        self.path = path
+        self.interval = interval
+        self.dirid = dirid
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        # renewals that keep failing let the lease lapse, the copy stops an interval ahead of it
+        self.deadline = time.time() + manager.leasetime - interval
+        self.thread = None
+        self.bucket = None
+
+    def throttle(self, bucket, host, dest):
+        # the share of the bandwidth follows the streams busy on the host and disk at each beat
+        self.bucket = (bucket, host, dest)
+
+    def alive(self):
+        return not self.lost.is_set() and time.time() < self.deadline
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        # renews the leases on its own connection, so a long copy never lets them lapse
+        heartbeatmanager = database.TaskManager(database.Database(self.path))
+        heartbeatmanager.workerid = manager.workerid
+        heartbeatmanager.leasetime = manager.leasetime
+        while not self.stopped.wait(self.interval):
+            try:
+                renewed = time.time()
+                if not heartbeatmanager.renewleases(self.dirid):
+                    self.lost.set()
+                    break
+                self.deadline = renewed + heartbeatmanager.leasetime - self.interval
+                if self.bucket:
+                    bucket, host, dest = self.bucket
+                    bucket.setrate(getrate(host, dest, *heartbeatmanager.getstreams(host['HostID'], dest['DestID'])))
+            except sqlite3.Error as why:
+                print(why)
+
+def gettablefile():
+    if getattr(local, 'path', None) != db.path:
+        local.tablefile = database.TableFile(database.Database(db.path))
+        local.path = db.path
+    return local.tablefile
+
+def resumeoffset(src, destfilepath, offset):
+    try:
+        if not offset or os.path.getsize(destfilepath) < offset:
+            return 0
+        length = min(verifysize, offset)
+        with open(destfilepath, 'rb') as dest:
+            dest.seek(offset - length)
+            src.seek(offset - length)
+            if dest.read(length) != src.read(length):
+                return 0
+    except OSError:
+        return 0
+    return offset
+
+class TokenBucket:
+    def __init__(self, rate, capacity = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def setrate(self, rate):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.capacity = rate
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+class Verifier:
+    def __init__(self, workers, rate):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.bucket = TokenBucket(rate)
+
+    def submit(self, fileid, destfilepath, algo, filehash, offset = 0, size = None):
+        return self.executor.submit(self.verify, fileid, destfilepath, algo, filehash, offset, size)
+
+    def verify(self, fileid, destfilepath, algo, filehash, offset = 0, size = None):
+        # a packed file is checked at its place in the container, not against the whole container
+        try:
+            if checksum.hashfile(destfilepath, algo, self.bucket, offset, size) == filehash:
+                return True
+            copystatus = 'Checksum mismatch'
+        except OSError as why:
+            copystatus = str(why)
+        print(destfilepath + ': ' + copystatus)
+        gettablefile().markfailed(fileid, copystatus)
+        return False
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait)
+
+def getverifier():
+    global verifier
+    if verifier is None:
+        verifier = Verifier(verifyworkers, verifyrate)
+    return verifier
+
+class BufferPool:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.used and self.used + size > self.capacity:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+class CopyJob:
+    def __init__(self, srcfilepath, destfilepath, fileid, offset, algo, bucket):
+        self.srcfilepath = srcfilepath
+        self.destfilepath = destfilepath
+        self.fileid = fileid
+        self.offset = offset
+        self.algo = algo
+        self.bucket = bucket
+        self.future = Future()
+        self.failed = False
+        self.dest = None
+        self.digest = None
+        self.checkpoint = 0
+        self.starttime = None
+
+class Pipeline:
+    def __init__(self, executor, capacity, labels = None):
+        self.executor = executor
+        self.labels = labels or {}
+        self.pool = BufferPool(capacity)
+        self.queue = queue.Queue()
+        self.submitted = 0
+        self.finished = 0
+        self.closing = False
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, srcfilepath, destfilepath, fileid = None, offset = 0, algo = None, bucket = None):
+        job = CopyJob(srcfilepath, destfilepath, fileid, offset, algo, bucket)
+        self.submitted += 1
+        self.executor.submit(self.read, job)
+        return job.future
+
+    def read(self, job):
+        job.starttime = time.perf_counter()
+        try:
+            with open(job.srcfilepath, 'rb') as src:
+                offset = resumeoffset(src, job.destfilepath, job.offset)
+                size = os.fstat(src.fileno()).st_size
+                self.queue.put(('open', job, offset))
+                src.seek(offset)
+                while offset < size and not (job.failed or job.future.cancelled()):
+                    count = min(readchunksize, size - offset)
+                    self.pool.acquire(count)
+                    data = src.read(count)
+                    self.pool.release(count - len(data))
+                    if not data:
+                        break
+                    if job.bucket:
+                        job.bucket.consume(len(data))
+                    self.queue.put(('data', job, data))
+                    offset += len(data)
+        except OSError as why:
+            self.queue.put(('error', job, why))
+        else:
+            self.queue.put(('close', job, None))
+
+    def write(self):
+        while not (self.closing and self.finished == self.submitted):
+            message, job, value = self.queue.get()
+            if message is None:
+                self.closing = True
+                continue
+            try:
+                if message in ('close', 'error'):
+                    self.finished += 1
+                if job.failed or job.future.cancelled():
+                    self.discard(job)
+                elif message == 'open':
+                    self.open(job, value)
+                elif message == 'data':
+                    self.writedata(job, value)
+                elif message == 'close':
+                    self.finish(job)
+                else:
+                    raise value
+            except Exception as why:
+                self.fail(job, why)
+            finally:
+                if message == 'data':
+                    self.pool.release(len(value))
+
+    def open(self, job, offset):
+        print(job.destfilepath)
+        job.checkpoint = offset
+        if job.algo:
+            job.digest = checksum.newhash(job.algo)
+            if offset:
+                checksum.updatehash(job.digest, job.destfilepath, offset)
+        job.dest = open(job.destfilepath, 'r+b' if offset else 'wb')
+        job.dest.truncate(offset)
+        job.dest.seek(offset)
+
+    def writedata(self, job, data):
+        job.dest.write(data)
+        if job.digest:
+            job.digest.update(data)
+        position = job.dest.tell()
+        if job.fileid is not None and position - job.checkpoint >= chunksize:
+            job.dest.flush()
+            os.fsync(job.dest.fileno())
+            gettablefile().updatecopyoffset(job.fileid, position, manager.workerid)
+            job.checkpoint = position
+
+    def finish(self, job):
+        job.dest.close()
+        job.dest = None
+        shutil.copystat(job.srcfilepath, job.destfilepath)
+        elapsed = time.perf_counter() - job.starttime
+        recordfile(self.labels, os.path.getsize(job.destfilepath), elapsed)
+        job.future.set_result((job.digest.hexdigest() if job.digest else None, elapsed))
+
+    def discard(self, job):
+        if job.dest:
+            job.dest.close()
+            job.dest = None
+
+    def fail(self, job, why):
+        job.failed = True
+        self.discard(job)
+        try:
+            if not job.checkpoint and os.path.exists(job.destfilepath):
+                os.remove(job.destfilepath)
+        except OSError:
+            pass
+        if not job.future.done():
+            job.future.set_exception(why)
+
+    def close(self):
+        self.queue.put((None, None, None))
+        self.writer.join()
+
+def copychunk(src, dest, offset, count, fast, digest = None):
+    if fast:
+        try:
+            if hasattr(os, 'copy_file_range'):
+                copied = os.copy_file_range(src.fileno(), dest.fileno(), count, offset, offset)
+            else:
+                dest.seek(offset)
+                copied = os.sendfile(dest.fileno(), src.fileno(), offset, count)
+            if copied:
+                return copied, True
+        except OSError as why:
+            if why.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                 errno.ENOTSUP, errno.ENOTSOCK, errno.EBADF):
+                raise
+    src.seek(offset)
+    dest.seek(offset)
+    data = src.read(count)
+    if digest:
+        digest.update(data)
+    view = memoryview(data)
+    while view:
+        view = view[dest.write(view):]
+    return len(data), False
+
+def copyfile(srcfilepath, destfilepath, fileid = None, offset = 0, algo = None, bucket = None):
     print(destfilepath)
-    shutil.copy2(srcfilepath, destfilepath)       
+    checkpoint = 0
+    try:
+        with open(srcfilepath, 'rb', buffering=0) as src:
+            offset = resumeoffset(src, destfilepath, offset)
+            checkpoint = offset
+            digest = None
+            if algo:
+                digest = checksum.newhash(algo)
+                if offset:
+                    checksum.updatehash(digest, destfilepath, offset)
+            with open(destfilepath, 'r+b' if offset else 'wb', buffering=0) as dest:
+                dest.truncate(offset)
+                size = os.fstat(src.fileno()).st_size
+                fast = not digest and (hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile'))
+                # throttled copies move at most one second of their share per chunk
+                count = min(chunksize, int(bucket.capacity)) if bucket else chunksize
+                while offset < size:
+                    copied, fast = copychunk(src, dest, offset, min(count, size - offset), fast, digest)
+                    if not copied:
+                        break
+                    if bucket:
+                        bucket.consume(copied)
+                    offset += copied
+                    if fileid is not None and offset < size and offset - checkpoint >= chunksize:
+                        os.fsync(dest.fileno())
+                        gettablefile().updatecopyoffset(fileid, offset, manager.workerid)
+                        checkpoint = offset
+        shutil.copystat(srcfilepath, destfilepath)
+    except OSError:
+        if not checkpoint and os.path.exists(destfilepath):
+            os.remove(destfilepath)
+        raise
+    return digest.hexdigest() if digest else None
 ##    printrepeatedly('.')
 
 ##if __name__ == '__main__':
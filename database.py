@@ -1,21 +1,35 @@
-import sqlite3, csv, time
+import sqlite3, csv, json, time, os, metrics
 from enum import IntEnum
 from pathlib import PurePath
 from shutil import disk_usage
 
 
 class Database():
-    def __init__(self):
-        self.connection = sqlite3.connect('..\\db\\sqlite3\\media.db', 10)
+    def __init__(self, path = '..\\db\\sqlite3\\media.db', timeout = 60):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout, cached_statements=256)
+        self.connection.execute('pragma journal_mode=wal')
+        self.connection.execute('pragma synchronous=normal')
+        self.connection.execute('pragma temp_store=memory')
+        self.connection.execute('pragma cache_size=-65536')
+        self.connection.execute('pragma mmap_size=268435456')
+        self.connection.execute('pragma wal_autocheckpoint=10000')
         self.cursor = self.connection.cursor()
         self.connection.row_factory = sqlite3.Row
+        self.readcursor = self.connection.cursor()
         self.transaction_depth = 0
         self.isolation_level=None
+        self.wakepath = path + '.wake'
+        self.notified = False
         
     def begin(self, isolation_level=''):
         levels = [None, '', 'immediate', 'exclusive']
-        if levels.index(isolation_level) > levels.index(self.isolation_level):
+        if self.transaction_depth == 0 and levels.index(isolation_level) > levels.index(self.isolation_level):
+            starttime = time.perf_counter()
             self.connection.execute('begin ' + isolation_level)
+            if isolation_level:
+                metrics.registry.observe('offlinebackup_db_lock_wait_seconds',
+                                         time.perf_counter() - starttime, level=isolation_level)
         self.transaction_depth += 1
 ##        print('begin ' + str(self.transaction_depth))
 
@@ -25,6 +39,8 @@ class Database():
             self.transaction_depth -= 1
         if self.transaction_depth == 0:
             self.connection.commit()
+            if self.notified:
+                self.wake()
 
     def rollback(self):
 ##        print('rollback ' + str(self.transaction_depth))
@@ -32,6 +48,51 @@ class Database():
             self.transaction_depth -= 1
         if self.transaction_depth == 0:
             self.connection.rollback()
+            self.notified = False
+
+    def query(self, sql, params = (), factory = sqlite3.Row):
+        # a lone select runs in its own read transaction, so plain reads skip begin/commit
+        self.readcursor.row_factory = factory
+        return self.readcursor.execute(sql, params).fetchall()
+
+    def queryone(self, sql, params = (), factory = sqlite3.Row):
+        self.readcursor.row_factory = factory
+        return fetchfirst(self.readcursor.execute(sql, params))
+
+    def notify(self):
+        self.notified = True
+        if self.transaction_depth == 0:
+            self.wake()
+
+    def wake(self):
+        self.notified = False
+        with open(self.wakepath, 'a'):
+            pass
+        os.utime(self.wakepath)
+
+    def wakestamp(self):
+        try:
+            return os.stat(self.wakepath).st_mtime_ns
+        except OSError:
+            return 0
+
+    def wait(self, stamp, timeout, interval = 0.5):
+        deadline = time.time() + timeout
+        while True:
+            if self.wakestamp() != stamp:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+
+    def analyze(self):
+        # sampled statistics are enough for the planner to choose between the composite indexes
+        self.connection.execute('pragma analysis_limit=1000')
+        self.connection.execute('analyze')
+
+    def analyzed(self):
+        return None != self.queryone("select 1 from sqlite_master where name='sqlite_stat1'")
 
     def drop_table(self, connection, tablename):
         self.connection.execute('Drop Table ' + tablename)
@@ -47,6 +108,45 @@ class CopyState(IntEnum):
     busy = 1
     finished = 2
 
+class FileRow:
+    __slots__ = ('FileID', 'FileName', 'ExtName', 'FileSize', 'Location', 'ActiveState',
+                 'CopyState', 'DestID', 'DirID', 'CopyStatus', 'CopyOffset', 'HashAlgo',
+                 'FileHash', 'DupOf')
+    columns = ', '.join('file.' + name for name in __slots__)
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def keys(self):
+        return self.__slots__
+
+    @classmethod
+    def factory(cls, cursor, row):
+        return cls(*row)
+
+def fetchfirst(cursor):
+    # step the statement to its end, an unfinished select keeps its read snapshot
+    # open and a later begin immediate on this connection fails with database is locked
+    row = cursor.fetchone()
+    if row is not None:
+        cursor.fetchall()
+    return row
+
+def indexname(sql):
+    words = sql.split()
+    return words[words.index('on') - 1]
+
+def samesql(left, right):
+    normalize = lambda sql: ' '.join(sql.lower().split()).replace(' if not exists', '')
+    return normalize(left) == normalize(right)
+
+def nonunique(sql):
+    return sql.replace('unique index', 'index', 1) + ' /* not unique, duplicate keys */'
+
 def printrepeatedly(objects):
     if not hasattr(printrepeatedly, 'index'):
         printrepeatedly.index=0
@@ -58,55 +158,89 @@ def printrepeatedly(objects):
 
 
 class Table:
+    indexes = ()
+
     def __init__(self, database, tablename):
         self.database = database
         self.connection = database.connection
         self.cursor = database.connection.cursor()
         self.tablename=tablename
+        self.sqlcountall = 'select count(*) from ' + tablename
+        self.sqlselectall = 'select * from ' + tablename
+        self.statements = {}
 
     def create(self):
         self.createtable()
         self.createindex()
 
     def countall(self):
-        self.database.begin()
-        try:
-            row=self.cursor.execute('Select count(*) from ' + self.tablename).fetchone()      
-        except:
-            self.database.rollback()
-            raise
-        else:   
-            self.database.commit()
-            if row:
-               return row[0]
-            else:
-                return 0
+        row = self.database.queryone(self.sqlcountall)
+        if row:
+            return row[0]
+        else:
+            return 0
     
     def printall(self):        
-        self.database.begin()
-        try:    
-            for row in self.cursor.execute('Select * from ' + self.tablename):
-                print(list(row))
-        except:
-            self.database.rollback()
-            raise
-        else:   
-            self.database.commit()
+        for row in self.database.query(self.sqlselectall):
+            print(list(row))
+
+    def addcolumns(self, columns):
+        names = [row[1] for row in self.connection.execute('pragma table_info(' + self.tablename + ')')]
+        for name, definition in columns:
+            if name not in names:
+                self.connection.execute('alter table ' + self.tablename + ' add column ' + name + ' ' + definition)
+
+    def maxid(self, columnname):
+        sql = self.statements.get(('maxid', columnname))
+        if sql is None:
+            sql = self.statements[('maxid', columnname)] = \
+                'select coalesce(max(' + columnname + '), 0) from ' + self.tablename
+        return self.database.queryone(sql)[0]
+
+    def createindex(self):
+        # index names are global to the database, so each table declares its own prefixed set;
+        # an index from an older schema, or declared differently now, is dropped and rebuilt.
+        # A unique index the data does not allow is kept as its marked non-unique fallback,
+        # drop it to try again once the duplicates are gone
+        declared = {indexname(sql): sql for sql in self.indexes}
+        existing = self.connection.execute('''select name, tbl_name, sql from sqlite_master
+                where type='index' and sql is not null and (tbl_name=? or name in (%s))'''
+                % ', '.join('?' * len(declared)), (self.tablename, *declared)).fetchall()
+        current = set()
+        for name, tablename, sql in existing:
+            if tablename == self.tablename and name in declared and \
+               (samesql(sql, declared[name]) or samesql(sql, nonunique(declared[name]))):
+                current.add(name)
+            else:
+                self.connection.execute('drop index if exists ' + name)
+        for name, sql in declared.items():
+            if name in current:
+                continue
+            try:
+                self.connection.execute(sql)
+            except sqlite3.IntegrityError as why:
+                print('%s: %s, created without unique' % (name, why))
+                self.connection.execute(nonunique(sql))
+
+    def dropindex(self, keep = ()):
+        for row in self.connection.execute('''select name from sqlite_master
+                where type='index' and tbl_name=? and sql is not null''',
+                (self.tablename, )).fetchall():
+            if row[0] not in keep:
+                self.connection.execute('drop index if exists ' + row[0])
 
     def exists(self, columnnames, columnvalues):
-        self.database.begin()
-        try:
-            select = 'select * from ' + self.tablename + ' where ' + ' and '.join(name + '=?' for name in columnnames)
-            row = self.cursor.execute(select, columnvalues).fetchone()
-        except:
-            self.database.rollback()
-            raise
-        else:   
-            self.database.commit()
-            return None != row
+        sql = self.statements.get(('exists', columnnames))
+        if sql is None:
+            sql = self.statements[('exists', columnnames)] = 'select 1 from ' + self.tablename + \
+                ' where ' + ' and '.join(name + '=?' for name in columnnames) + ' limit 1'
+        return None != self.database.queryone(sql, columnvalues)
 
 
 class TableHost(Table):
+    indexes = ('create unique index if not exists iHostID on TableHost(HostID)',
+               'create index if not exists iHostAddr on TableHost(HostAddr)')
+
     def __init__(self, database):
         super().__init__(database, 'TableHost')
 
@@ -115,12 +249,7 @@ class TableHost(Table):
             (HostID int, HostAddr text, ActiveState int default 0,
             CopyState int default 0, DestID int,
             CreateTime TimeStamp default (datetime('now', 'localtime')))''')
-
-    def createindex(self):
-        self.connection.executescript('''
-            create index if not exists iHostID on TableHost(HostID);            
-            create index if not exists iHostAddr on TableHost(HostAddr);
-            ''')
+        self.addcolumns((('MaxStreams', 'int default 1'), ('Bandwidth', 'int default 0')))
     
     def append(self, csvfile):
         with open(csvfile) as infile:
@@ -129,8 +258,9 @@ class TableHost(Table):
             try:
                 for row in reader:
                     if(not self.exists(('HostAddr', ), (row['HostAddr'], ))):
-                        self.connection.execute('''Insert Into TableHost(HostID, HostAddr)
-                            Values(?, ?)''', (row['HostID'], row['HostAddr']))
+                        self.connection.execute('''Insert Into TableHost(HostID, HostAddr, MaxStreams, Bandwidth)
+                            Values(?, ?, ?, ?)''', (row['HostID'], row['HostAddr'],
+                            row.get('MaxStreams') or 1, row.get('Bandwidth') or 0))
                     print('.', end='')
             except:
                 self.database.rollback()
@@ -138,6 +268,50 @@ class TableHost(Table):
             else:   
                 self.database.commit()
 
+    def addhost(self, hostid, hostaddr):
+        self.database.begin('immediate')
+        try:
+            if(not self.exists(('HostID', ), (hostid, ))):
+                self.connection.execute('''Insert Into TableHost(HostID, HostAddr)
+                    Values(?, ?)''', (hostid, hostaddr))
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
+
+    def gethost(self, hostid):
+        return self.database.queryone('select * from TableHost where HostID=?', (hostid, ))
+
+    def setlimits(self, hostid, maxstreams, bandwidth):
+        self.database.begin()
+        try:
+            self.cursor.execute('''update TableHost set MaxStreams=?, Bandwidth=? where HostID=?''',
+                                (maxstreams, bandwidth, hostid))
+            self.database.notify()
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
+
+    def releasecopystate(self, dirID):
+        # other streams may still be reading from this host, it goes idle with the last one
+        self.database.begin()
+        try:
+            self.cursor.execute('''update TableHost set CopyState=?
+                            where HostID in (Select HostID from TableDir where DirID=?)
+                            and CopyState=? and not exists
+                            (select 1 from TableTask as Busy inner join TableDir as BusyDir
+                            on Busy.DirID=BusyDir.DirID
+                            where BusyDir.HostID=TableHost.HostID and Busy.CopyState=?)''',
+                           (CopyState.idle, dirID, CopyState.busy, CopyState.busy))
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
+
     def updatecopystate(self, dirID, copystate):
         self.database.begin()
         try:
@@ -166,6 +340,7 @@ class TableHost(Table):
         try:
             self.cursor.execute('''update TableHost set ActiveState=? where HostID=?''',
                            (activestate, hostid))
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -177,6 +352,7 @@ class TableHost(Table):
         try:
             self.cursor.execute('''update TableHost set ActiveState=? ''',
                            (activestate, ))
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -185,6 +361,14 @@ class TableHost(Table):
 
 
 class TableDir(Table):
+    indexes = ('create unique index if not exists iDirID on TableDir(DirID)',
+               'create index if not exists iDirHostID on TableDir(HostID)',
+               'create index if not exists iDirDestID on TableDir(DestID)',
+               'create index if not exists iDirName on TableDir(DirName, Location)',
+               # only the dirs still waiting for a task, so finddir stays small as the copy progresses
+               '''create index if not exists iDirIdle on TableDir(HostID, FilesSize)
+                  where ActiveState=%d and CopyState=%d''' % (ActiveState.active, CopyState.idle))
+
     def __init__(self, database):
         super().__init__(database, 'TableDir')
 
@@ -194,23 +378,26 @@ class TableDir(Table):
             Location text, ActiveState int default 0, CopyState int default 0,
             HostID int, DestID int, 
             CreateTime TimeStamp default (datetime('now', 'localtime')))''')
+        self.addcolumns((('PackMode', 'int default 0'), ('FilesCount', 'int default 0')))
 
-    def createindex(self):
-        self.connection.executescript('''
-            create index if not exists iDirID on TableDir(DirID);            
-            create index if not exists iHostID on TableDir(HostID);            
-            create index if not exists iDestID on TableDir(DestID);
-            create index if not exists iDirName on TableDir(DirName, Location);
-            ''')
-
-    def update_filessize(self):
-        self.database.begin('exclusive')
+    def update_filessize(self, staged = False):
+        # TableFile triggers keep FilesSize/FilesCount current, this rebuilds them from scratch
+        # (or only the dirs in StageFile) with one grouped pass over TableFile
+        where = ' and DirID in (select DirID from StageFile)' if staged else ''
+        self.database.begin('immediate')
         try:
-            self.connection.executescript('''
-                update TableDir set FilesSize =
-                        (select sum(FileSize) from TableFile
-                        where TableFile.DirID=TableDir.DirID and TableFile.CopyState=0)
-                ''')
+            self.connection.execute('''create temp table if not exists DirTotals
+                (DirID integer primary key, FilesSize int, FilesCount int)''')
+            self.connection.execute('delete from DirTotals')
+            self.connection.execute('''insert into DirTotals
+                select DirID, sum(FileSize), count(*) from TableFile
+                where CopyState=? and DirID is not null''' + where + ' group by DirID',
+                (CopyState.idle, ))
+            self.connection.execute('''update TableDir set
+                FilesSize=coalesce((select FilesSize from DirTotals where DirTotals.DirID=TableDir.DirID), 0),
+                FilesCount=coalesce((select FilesCount from DirTotals where DirTotals.DirID=TableDir.DirID), 0)
+                where 1''' + where)
+            self.connection.execute('delete from DirTotals')
         except:
             self.database.rollback()
             raise
@@ -236,42 +423,36 @@ class TableDir(Table):
             else:                   
                 self.database.commit()
 
-    def getdir(self, dirid):
-        self.database.begin()
+    def insertdirs(self, dirs):
+        self.database.begin('immediate')
         try:
-            self.cursor.execute('select * from TableDir where DirID=?',
-                                (dirid, ))
-            dir = self.cursor.fetchone()
+            self.cursor.executemany('''Insert Into TableDir
+                (DirID, DirName, DirSize, Location, HostID, FilesSize)
+                Values(?, ?, ?, ?, ?, ?)''', dirs)
         except:
             self.database.rollback()
             raise
-        else:   
+        else:
             self.database.commit()
-            return dir
+
+    def getdir(self, dirid):
+        return self.database.queryone('select * from TableDir where DirID=?', (dirid, ))
+
+    def getdirids(self):
+        return {(row['DirName'], row['Location']): row['DirID'] for row in
+                self.database.query('Select DirID, DirName, Location from TableDir')}
 
     def getdirid(self, path):
-        self.database.begin()
-        try:
-            p = PurePath(path)
-            p.name, p.parent
-    
-            if p.parent == '.':
-                where = ' Where DirName=?'
-                params = (p.name, )
-            else:
-                where = ' Where DirName=? And Location=?'
-                params = (p.name, str(p.parent))
-                
-            row = self.cursor.execute('Select DirID from TableDir ' + where, params).fetchone()
-        except:
-            self.database.rollback()
-            raise
-        else:   
-            self.database.commit()
-            if row:
-                return row[0]
-            else:
-                return 0
+        p = PurePath(path)
+        if p.parent == '.':
+            row = self.database.queryone('Select DirID from TableDir Where DirName=?', (p.name, ))
+        else:
+            row = self.database.queryone('Select DirID from TableDir Where DirName=? And Location=?',
+                                         (p.name, str(p.parent)))
+        if row:
+            return row[0]
+        else:
+            return 0
 
     def updatecopystate(self, dirID, copystate):
         self.database.begin()
@@ -299,6 +480,7 @@ class TableDir(Table):
         try:
             self.cursor.execute('''update TableDir set ActiveState=? where DirID=?''',
                            (activestate, dirid))
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -310,6 +492,18 @@ class TableDir(Table):
         try:
             self.cursor.execute('''update TableDir set ActiveState=? ''',
                            (activestate, ))
+            self.database.notify()
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
+
+    def setpackmode(self, dirid, packmode):
+        self.database.begin()
+        try:
+            self.cursor.execute('''update TableDir set PackMode=? where DirID=?''',
+                           (packmode, dirid))
         except:
             self.database.rollback()
             raise
@@ -326,8 +520,49 @@ class TableDir(Table):
             raise
         else:
             self.database.commit()
+
+    def applydeltas(self, deltas, hostid = None):
+        self.database.begin('immediate')
+        try:
+            dirid = fetchfirst(self.cursor.execute('select coalesce(max(DirID), 0) from TableDir'))[0]
+            for delta, kind, location, name, size in deltas:
+                if kind != 'dir':
+                    continue
+                if delta == 'added':
+                    if not self.exists(('DirName', 'Location'), (name, location)):
+                        dirid += 1
+                        self.cursor.execute('''Insert Into TableDir
+                            (DirID, DirName, DirSize, Location, HostID)
+                            Values(?, ?, ?, ?, ?)''', (dirid, name, size, location, hostid))
+                elif delta == 'removed':
+                    self.cursor.execute('''update TableDir set ActiveState=?
+                        where DirName=? and Location=?''', (ActiveState.inactive, name, location))
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
         
 class TableFile(Table):
+    sqlclaimfiles = 'select ' + FileRow.columns + ''' from TableFile as file
+        inner join TableDir as dir on file.DirID=dir.DirID
+        where file.DirID=? and file.CopyState=? and file.ActiveState=?
+        and file.FileSize<? and dir.ActiveState=? order by file.CopyOrder, file.FileID limit ?'''
+    sqlfilefrom = '''select file.* from TableFile as file
+        inner join TableDir as dir on file.DirID=dir.DirID
+        where file.DirID=? and file.CopyState=? and file.ActiveState=?
+        and file.FileSize<? and dir.ActiveState=? order by file.CopyOrder, file.FileID limit 1'''
+    duplicateentry = "(CopyState=%d and coalesce(CopyStatus, '') like 'Duplicate of%%')" % CopyState.finished
+    sqlcountidle = 'select count(*) from TableFile where DirID=? and CopyState=? and ActiveState=?'
+    sqlcountunordered = 'select count(*) from TableFile where DirID=? and CopyState=? and CopyOrder is null'
+    indexes = ('create unique index if not exists iFileID on TableFile(FileID)',
+               # claims filter on the first three columns and read the rest in claim order
+               'create index if not exists iFileDir on TableFile(DirID, CopyState, ActiveState, CopyOrder, FileID)',
+               'create index if not exists iFileDestID on TableFile(DestID)',
+               'create index if not exists iFileName on TableFile(FileName, ExtName, Location)',
+               'create index if not exists iFileLease on TableFile(LeaseExpiry) where LeaseExpiry is not null',
+               'create index if not exists iFileDupOf on TableFile(DupOf) where DupOf is not null')
+
     def __init__(self, database):
         super().__init__(database, 'TableFile')
 
@@ -338,22 +573,46 @@ class TableFile(Table):
             DestID int, DirID int, CopyStatus text,
             CreateTime TimeStamp default (datetime('now', 'localtime')),
             CopyTime TimeStamp)''')
+        self.addcolumns((('CopyOffset', 'int default 0'), ('HashAlgo', 'text'), ('FileHash', 'text'),
+                         ('DupOf', 'int'), ('WorkerID', 'text'), ('LeaseExpiry', 'int'),
+                         ('CopyOrder', 'int')))
 
-    def createindex(self):
-        self.connection.executescript('''
-            create index if not exists iFileID on TableFile(FileID);            
-            create index if not exists iDirID on TableFile(DirID);
-            create index if not exists iDestID on TableFile(DestID);
-            create index if not exists iFileName on TableFile(FileName, ExtName, Location);
-            ''')
+    def create(self):
+        super().create()
+        if not self.hastriggers():
+            self.createtriggers()
+            TableDir(self.database).update_filessize()
 
-    def dropindex(self):
-        self.connection.executescript('''
-            drop index iFileID;
-            drop index iDirID;
-            drop index iDestID;
-            drop index iFileName;
-            ''')
+    def hastriggers(self):
+        return self.database.queryone('''select count(*) from sqlite_master
+            where type='trigger' and tbl_name=?''', (self.tablename, ))[0] == 3
+
+    def createtriggers(self):
+        for sql in ('''create trigger if not exists tFileInsert after insert on TableFile
+                when new.CopyState=0
+                begin
+                    update TableDir set FilesSize=coalesce(FilesSize, 0)+coalesce(new.FileSize, 0),
+                        FilesCount=coalesce(FilesCount, 0)+1 where DirID=new.DirID;
+                end''',
+                    '''create trigger if not exists tFileDelete after delete on TableFile
+                when old.CopyState=0
+                begin
+                    update TableDir set FilesSize=coalesce(FilesSize, 0)-coalesce(old.FileSize, 0),
+                        FilesCount=coalesce(FilesCount, 0)-1 where DirID=old.DirID;
+                end''',
+                    '''create trigger if not exists tFileUpdate after update of CopyState, FileSize, DirID
+                on TableFile when old.CopyState=0 or new.CopyState=0
+                begin
+                    update TableDir set FilesSize=coalesce(FilesSize, 0)-coalesce(old.FileSize, 0),
+                        FilesCount=coalesce(FilesCount, 0)-1 where old.CopyState=0 and DirID=old.DirID;
+                    update TableDir set FilesSize=coalesce(FilesSize, 0)+coalesce(new.FileSize, 0),
+                        FilesCount=coalesce(FilesCount, 0)+1 where new.CopyState=0 and DirID=new.DirID;
+                end'''):
+            self.connection.execute(sql)
+
+    def droptriggers(self):
+        for name in ('tFileInsert', 'tFileDelete', 'tFileUpdate'):
+            self.connection.execute('drop trigger if exists ' + name)
 
     def append(self, csvfile, repeated = False):
         tableDir = TableDir(self.database)
@@ -376,34 +635,258 @@ class TableFile(Table):
             else:                   
                 self.database.commit()
 
-    def getfile(self, fileid):
+    def createstage(self):
+        self.connection.execute('''create temp table if not exists StageFile
+            (FileID int, FileName text, ExtName text, FileSize int,
+            Location text, DirID int)''')
         self.database.begin()
         try:
-            self.cursor.execute('select * from TableFile where FileID=?',
-                                (fileid, ))
-            file = self.cursor.fetchone()
+            self.connection.execute('delete from StageFile')
         except:
             self.database.rollback()
             raise
-        else:   
+        else:
             self.database.commit()
-            return file
 
-    def getfilefrom(self, dirid, copystate, maxsize):
+    def stage(self, rows):
         self.database.begin()
         try:
-            self.cursor.execute('''select file.* from TableFile as file
-                                inner join TableDir as dir on file.DirID=dir.DirID
-                                where file.DirID=? and file.CopyState=? and file.ActiveState=?
-                                and file.FileSize<? and dir.ActiveState=?''',
-                                (dirid, copystate, ActiveState.active, maxsize, ActiveState.active))
-            file = self.cursor.fetchone()
+            self.cursor.executemany('''Insert Into StageFile
+                (FileID, FileName, ExtName, FileSize, Location, DirID)
+                Values(?, ?, ?, ?, ?, ?)''', rows)
+            count = self.cursor.rowcount
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+            return count
+
+    def mergestage(self, repeated = False):
+        select = '''select FileID, FileName, ExtName, FileSize, Location, DirID
+            from StageFile as stage'''
+        if not repeated:
+            select += ''' where stage.rowid in
+                (select min(rowid) from StageFile group by FileName, ExtName, Location)
+                and not exists (select 1 from TableFile as file
+                where file.FileName=stage.FileName and file.ExtName=stage.ExtName
+                and file.Location=stage.Location)'''
+        self.database.begin('immediate')
+        try:
+            # one grouped rebuild of the staged dirs instead of a trigger update per row,
+            # done inside the write lock so no other writer misses the triggers
+            self.droptriggers()
+            self.cursor.execute('''Insert Into TableFile
+                (FileID, FileName, ExtName, FileSize, Location, DirID) ''' + select)
+            count = self.cursor.rowcount
+            TableDir(self.database).update_filessize(staged=True)
+            self.createtriggers()
+            self.connection.execute('delete from StageFile')
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+            return count
+
+    def loadstage(self, repeated = False):
+        # the merge looks up duplicates through iFileName, so only that one survives
+        self.dropindex(() if repeated else ('iFileName', ))
+        try:
+            return self.mergestage(repeated)
+        finally:
+            self.createindex()
+            self.database.analyze()
+
+    def bulkappend(self, csvfile, repeated = False):
+        starttime = time.time()
+        dirids = TableDir(self.database).getdirids()
+
+        def readrows(reader):
+            for row in reader:
+                p = PurePath(row['Location'])
+                yield (row['FileID'], row['FileName'], row['ExtName'], row['FileSize'],
+                       row['Location'], dirids.get((p.name, str(p.parent)), 0))
+
+        self.createstage()
+        with open(csvfile) as infile:
+            rows = self.stage(readrows(csv.DictReader(infile)))
+        inserted = self.loadstage(repeated)
+        elapsed = max(time.time() - starttime, 1e-6)
+        print('%d rows read, %d rows inserted in %.1fs (%.0f rows/s)'
+              % (rows, inserted, elapsed, rows / elapsed))
+        return inserted
+
+    def getfile(self, fileid):
+        return self.database.queryone('select * from TableFile where FileID=?', (fileid, ))
+
+    def getfilesof(self, dirid):
+        return self.database.query('''select FileID, FileName, ExtName, FileSize, ActiveState, Location
+                                   from TableFile where DirID=?''', (dirid, ))
+
+    def countunordered(self, dirid):
+        return self.database.queryone(self.sqlcountunordered, (dirid, CopyState.idle))[0]
+
+    def setcopyorder(self, orders):
+        self.database.begin('immediate')
+        try:
+            self.cursor.executemany('''update TableFile set CopyOrder=? where FileID=?''', orders)
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+
+    def applydeltas(self, deltas):
+        tableDir = TableDir(self.database)
+        self.database.begin('immediate')
+        try:
+            fileid = fetchfirst(self.cursor.execute('select coalesce(max(FileID), 0) from TableFile'))[0]
+            for delta, kind, location, name, size in deltas:
+                if kind != 'file':
+                    continue
+                p = PurePath(name)
+                if delta == 'added':
+                    # a file that comes back gets its old row reactivated rather than a second one
+                    row = fetchfirst(self.cursor.execute('''select FileSize from TableFile
+                        where FileName=? and ExtName=? and Location=?''', (p.stem, p.suffix, location)))
+                    if row is None:
+                        fileid += 1
+                        dirID = tableDir.getdirid(location)
+                        self.cursor.execute('''Insert Into TableFile
+                            (FileID, FileName, ExtName, FileSize, Location, DirID, ActiveState)
+                            Values(?, ?, ?, ?, ?, ?,
+                            coalesce((select ActiveState from TableDir where DirID=?), 0))''',
+                            (fileid, p.stem, p.suffix, size, location, dirID, dirID))
+                        continue
+                    if row[0] != size:
+                        self.resetchanged(p, location, size)
+                    self.cursor.execute('''update TableFile set
+                        ActiveState=coalesce((select ActiveState from TableDir where DirID=TableFile.DirID), 0)
+                        where FileName=? and ExtName=? and Location=?''', (p.stem, p.suffix, location))
+                elif delta == 'modified':
+                    self.resetchanged(p, location, size)
+                elif delta == 'removed':
+                    self.cursor.execute('''update TableFile set ActiveState=?
+                        where FileName=? and ExtName=? and Location=?''',
+                        (ActiveState.inactive, p.stem, p.suffix, location))
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+
+    def resetchanged(self, p, location, size):
+        # the old content is gone, so copies recorded as duplicates of it need their own
+        # copy and anything still waiting to link to it no longer may
+        changed = '''(select FileID from TableFile where FileName=? and ExtName=? and Location=?)'''
+        self.cursor.execute('''update TableFile set DestID=NULL, CopyState=?, CopyStatus=NULL,
+            CopyOffset=0, FileHash=NULL, DupOf=NULL where ''' + self.duplicateentry + '''
+            and DupOf in ''' + changed, (CopyState.idle, p.stem, p.suffix, location))
+        self.cursor.execute('update TableFile set DupOf=NULL where DupOf in ' + changed,
+                            (p.stem, p.suffix, location))
+        self.cursor.execute('''update TableFile set FileSize=?, DestID=NULL,
+            CopyState=?, CopyStatus=NULL, CopyOffset=0, FileHash=NULL, DupOf=NULL
+            where FileName=? and ExtName=? and Location=?''',
+            (size, CopyState.idle, p.stem, p.suffix, location))
+
+    def getcopied(self, dirid = None, location = None, name = None):
+        where = ['CopyState=?']
+        params = [CopyState.finished]
+        if dirid is not None:
+            where.append('DirID=?')
+            params.append(dirid)
+        if location is not None:
+            where.append('Location glob ?')
+            params.append(location)
+        if name is not None:
+            where.append('FileName || ExtName glob ?')
+            params.append(name)
+        return self.database.query('select * from TableFile where ' + ' and '.join(where), params)
+
+    def countidle(self, dirid):
+        return self.database.queryone(self.sqlcountidle, (dirid, CopyState.idle, ActiveState.active))[0]
+
+    def getsizegroups(self):
+        return self.database.query('''select * from TableFile
+            where ActiveState=? and FileSize in
+            (select FileSize from TableFile where ActiveState=? and FileSize>0
+            group by FileSize having count(*)>1)
+            order by FileSize''', (ActiveState.active, ActiveState.active))
+
+    def updatehashes(self, hashes):
+        self.database.begin('immediate')
+        try:
+            self.cursor.executemany('''update TableFile set HashAlgo=?, FileHash=? where FileID=?''',
+                                    hashes)
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+
+    def setduplicates(self, duplicates):
+        self.database.begin('immediate')
+        try:
+            # a finished duplicate entry has no data of its own, restore reads it through DupOf
+            self.cursor.execute('update TableFile set DupOf=NULL where DupOf is not NULL and not '
+                                + self.duplicateentry)
+            self.cursor.executemany('update TableFile set DupOf=? where FileID=? and not ' + self.duplicateentry,
+                                    duplicates)
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+
+    def getfilefrom(self, dirid, copystate, maxsize):
+        return self.database.queryone(self.sqlfilefrom,
+                                      (dirid, copystate, ActiveState.active, maxsize, ActiveState.active))
+
+    def claimfiles(self, dirid, destid, copystate, count, budget, workerid = None, leaseexpiry = None):
+        self.database.begin('immediate')
+        try:
+            files = []
+            # None, not an empty claim, once the task on dirid was reclaimed from workerid
+            if workerid is not None and not fetchfirst(self.cursor.execute('''select 1 from TableTask
+                    where DirID=? and WorkerID=? and CopyState=?''', (dirid, workerid, CopyState.busy))):
+                files = None
+            else:
+                for file in self.database.query(self.sqlclaimfiles,
+                                                (dirid, copystate, ActiveState.active, budget, ActiveState.active, count),
+                                                FileRow.factory):
+                    if file.FileSize < budget:
+                        budget -= file.FileSize
+                        files.append(file)
+                self.cursor.executemany('''update TableFile set DestID=?, CopyState=?, CopyStatus=NULL,
+                                        WorkerID=?, LeaseExpiry=? where FileID=?''',
+                                        ((destid, CopyState.busy, workerid, leaseexpiry, file.FileID) for file in files))
         except:
             self.database.rollback()
             raise
         else:   
             self.database.commit()        
-            return file
+            return files
+
+    def completefiles(self, destid, results, hashalgo = None, workerid = None):
+        self.database.begin('immediate')
+        try:
+            # a finished copy has no resume point, a stale checkpoint would let a later retry
+            # keep the bytes in front of it; with a workerid, a file reclaimed by another
+            # worker is left to it
+            self.cursor.executemany('''update TableFile set DestID=?, CopyState=?, CopyStatus=?,
+                                    HashAlgo=?, FileHash=?, WorkerID=NULL, LeaseExpiry=NULL,
+                                    CopyOffset=case when ?=%d then 0 else CopyOffset end,
+                                    CopyTime=datetime('now', 'localtime')
+                                    where FileID=? and (? is null or WorkerID=?)''' % CopyState.finished,
+                                    ((destid, copystate, copystatus, filehash and hashalgo, filehash, copystate,
+                                      fileid, workerid, workerid)
+                                     for fileid, copystate, copystatus, filehash in results))
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
 
     def updatecopystate(self, fileid, destid, copystate, copystatus = None):
         self.database.begin()
@@ -416,6 +899,40 @@ class TableFile(Table):
         else:   
             self.database.commit()
 
+    def updatecopyoffset(self, fileid, offset, workerid = None):
+        self.database.begin()
+        try:
+            self.cursor.execute('''update TableFile set CopyOffset=? where FileID=? and (? is null or WorkerID=?)''',
+                           (offset, fileid, workerid, workerid))
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
+
+    def markfailed(self, fileid, copystatus):
+        self.database.begin()
+        try:
+            self.cursor.execute('''update TableFile set CopyState=?, CopyStatus=?, CopyOffset=0 where FileID=?''',
+                           (CopyState.failed, copystatus, fileid))
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
+
+    def resetfailed(self, dirid):
+        self.database.begin()
+        try:
+            self.cursor.execute('''update TableFile set CopyState=? 
+                           where DirID=? and CopyState=? and CopyOffset>0''',
+                           (CopyState.idle, dirid, CopyState.failed))
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
+
     def updatecopystateofdir(self, dirid, destid, copystate, copystatus = None):
         self.database.begin()
         try:
@@ -430,7 +947,7 @@ class TableFile(Table):
     def _zerocopystate(self):
         self.database.begin('exclusive')
         try:
-            self.cursor.execute('update TableFile set DestID=NULL, CopyState=? ', (CopyState.idle, ))      
+            self.cursor.execute('update TableFile set DestID=NULL, CopyState=?, CopyOffset=0 ', (CopyState.idle, ))      
         except:
             self.database.rollback()
             raise
@@ -442,6 +959,7 @@ class TableFile(Table):
         try:
             self.cursor.execute('''update TableFile set ActiveState=? where FileID=?''',
                            (activestate, fileid))
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -453,6 +971,7 @@ class TableFile(Table):
         try:
             self.cursor.execute('''update TableFile set ActiveState=? ''',
                            (activestate, ))
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -464,6 +983,7 @@ class TableFile(Table):
         try:
             self.cursor.execute('''update TableFile set ActiveState=? where DirID=?''',
                            (activestate, dirid))
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -472,6 +992,9 @@ class TableFile(Table):
 
                 
 class TableDest(Table):
+    indexes = ('create unique index if not exists iDestID on TableDest(DestID)',
+               'create index if not exists iDiskSN on TableDest(DiskSN, DiskBatch)')
+
     def __init__(self, database):
         super().__init__(database, 'TableDest')
 
@@ -480,12 +1003,7 @@ class TableDest(Table):
             (DestID int, DiskSN text, DiskBatch text, DiskModel text,
             DiskCapacity int, DiskPath text, ActiveState int default 0, CopyState int default 0, 
             CreateTime TimeStamp default (datetime('now', 'localtime')))''')
-
-    def createindex(self):
-        self.connection.executescript('''
-            create index if not exists iDestID on TableDest(DestID);
-            create index if not exists iDiskSN on TableDest(DiskSN, DiskBatch);
-            ''')
+        self.addcolumns((('MaxStreams', 'int default 1'), ('Bandwidth', 'int default 0')))
 
     def append(self, csvfile):
         num=0
@@ -497,9 +1015,11 @@ class TableDest(Table):
                 try:
                     if(not self.exists(('DiskBatch', 'DiskSN'), (row['DiskBatch'], row['DiskSN']))):
                         self.connection.execute('''Insert Into TableDest
-                            (DestID, DiskBatch, DiskSN, DiskModel, DiskCapacity, DiskPath)
-                            Values(?, ?, ?, ?, ?, ?)''',
-                            (row['DestID'], row['DiskBatch'], row['DiskSN'], row['DiskModel'], row['DiskCapacity'], row['DiskPath']))
+                            (DestID, DiskBatch, DiskSN, DiskModel, DiskCapacity, DiskPath, MaxStreams, Bandwidth)
+                            Values(?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (row['DestID'], row['DiskBatch'], row['DiskSN'], row['DiskModel'], row['DiskCapacity'], row['DiskPath'],
+                             row.get('MaxStreams') or 1, row.get('Bandwidth') or 0))
+                        self.database.notify()
                 except:
                     self.database.rollback()
                     raise
@@ -507,17 +1027,32 @@ class TableDest(Table):
                     self.database.commit()
 
     def getdest(self, destid):
+        return self.database.queryone('select * from TableDest where DestID=?', (destid, ))
+
+    def setlimits(self, destid, maxstreams, bandwidth):
+        self.database.begin()
+        try:
+            self.cursor.execute('''update TableDest set MaxStreams=?, Bandwidth=? where DestID=?''',
+                                (maxstreams, bandwidth, destid))
+            self.database.notify()
+        except:
+            self.database.rollback()
+            raise
+        else:   
+            self.database.commit()
+
+    def releasecopystate(self, destid):
         self.database.begin()
         try:
-            self.cursor.execute('select * from TableDest where DestID=?',
-                           (destid, ))
-            dest = self.cursor.fetchone()
+            self.cursor.execute('''update TableDest set CopyState=? where DestID=? and CopyState=?
+                            and not exists (select 1 from TableTask as Busy
+                            where Busy.DestID=TableDest.DestID and Busy.CopyState=?)''',
+                           (CopyState.idle, destid, CopyState.busy, CopyState.busy))
         except:
             self.database.rollback()
             raise
         else:   
             self.database.commit()
-            return dest
 
     def updatecopystate(self, destinationID, copystate):
         self.database.begin()
@@ -545,6 +1080,7 @@ class TableDest(Table):
         try:
             self.cursor.execute('''update TableDest set ActiveState=? where DestID=?''',
                            (activestate, destid))
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -556,6 +1092,7 @@ class TableDest(Table):
         try:
             self.cursor.execute('''update TableDest set ActiveState=? ''',
                            (activestate, ))
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -563,6 +1100,10 @@ class TableDest(Table):
             self.database.commit()
 
 class TableTask(Table):
+    indexes = ('create index if not exists iTaskState on TableTask(CopyState, DestID, DirID)',
+               'create index if not exists iTaskDirID on TableTask(DirID)',
+               'create index if not exists iTaskLease on TableTask(LeaseExpiry) where LeaseExpiry is not null')
+
     def __init__(self, database):
         super().__init__(database, 'TableTask')
 
@@ -570,30 +1111,10 @@ class TableTask(Table):
         self.cursor.execute('''create table if not exists TableTask
             (TaskID INTEGER PRIMARY KEY AUTOINCREMENT, DestID, DirID int, CopyState int default 0)
             ''')
-
-    def createindex(self):
-        self.cursor.executescript('''
-            create index if not exists iDestID on TableTask(DestID);
-            create index if not exists iDirID on TableTask(DirID);
-            ''')
-
-    def dropindex(self):
-        self.cursor.executescript('''
-            drop index iDestID;
-            drop index iDirID;
-            ''')
+        self.addcolumns((('WorkerID', 'text'), ('LeaseExpiry', 'int')))
 
     def gettask(self, taskid):
-        self.database.begin()
-        try:
-            task = self.cursor.execute('''select * from TableTask where taskID=?''',
-                                       (taskid, )).fetchone()
-        except:
-            self.database.rollback()
-            raise
-        else:   
-            self.database.commit()
-            return task
+        return self.database.queryone('select * from TableTask where TaskID=?', (taskid, ))
 
     def removetask(self, taskID):
         self.database.begin()
@@ -608,8 +1129,12 @@ class TableTask(Table):
     def updatecopystate(self, taskid, copystate):
         self.database.begin()
         try:
-            self.cursor.execute('''update TableTask set CopyState=? where TaskID=?''',
-                                (copystate, taskid))      
+            if copystate == CopyState.busy:
+                self.cursor.execute('''update TableTask set CopyState=? where TaskID=?''',
+                                    (copystate, taskid))      
+            else:
+                self.cursor.execute('''update TableTask set CopyState=?, WorkerID=NULL, LeaseExpiry=NULL
+                                    where TaskID=?''', (copystate, taskid))
         except:
             self.database.rollback()
             raise
@@ -617,7 +1142,166 @@ class TableTask(Table):
             self.database.commit()
         
         
+class TablePack(Table):
+    indexes = ('create unique index if not exists iPackFileID on TablePack(FileID)', )
+
+    def __init__(self, database):
+        super().__init__(database, 'TablePack')
+
+    def createtable(self):
+        self.connection.execute('''create table if not exists TablePack
+            (FileID int, DestID int, Container text, Offset int, Size int,
+            CreateTime TimeStamp default (datetime('now', 'localtime')))''')
+
+    def appendpacks(self, packs):
+        self.database.begin('immediate')
+        try:
+            self.cursor.executemany('''delete from TablePack where FileID=?''',
+                                    ((pack[0], ) for pack in packs))
+            self.cursor.executemany('''Insert Into TablePack
+                (FileID, DestID, Container, Offset, Size) Values(?, ?, ?, ?, ?)''', packs)
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+
+    def getpack(self, fileid):
+        return self.database.queryone('select * from TablePack where FileID=?', (fileid, ))
+
+
+class TableSnapshot(Table):
+    indexes = ('create unique index if not exists iSnapshotPath on TableSnapshot(Path)',
+               'create index if not exists iSnapshotParent on TableSnapshot(Parent)')
+
+    def __init__(self, database):
+        super().__init__(database, 'TableSnapshot')
+
+    def createtable(self):
+        self.connection.execute('''create table if not exists TableSnapshot
+            (Path text, Parent text, MTime int, EntryCount int, TotalSize int,
+            ScanTime TimeStamp default (datetime('now', 'localtime')))''')
+
+    def getsnapshot(self, path):
+        return self.database.queryone('select * from TableSnapshot where Path=?', (path, ))
+
+    def getchildren(self, path):
+        return [row[0] for row in self.database.query('select Path from TableSnapshot where Parent=?', (path, ))]
+
+    def savesnapshots(self, snapshots):
+        self.database.begin('immediate')
+        try:
+            self.cursor.executemany('''insert or replace into TableSnapshot
+                (Path, Parent, MTime, EntryCount, TotalSize) Values(?, ?, ?, ?, ?)''',
+                snapshots)
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+
+    def removesnapshots(self, paths):
+        self.database.begin('immediate')
+        try:
+            self.cursor.executemany('delete from TableSnapshot where Path=?',
+                                    ((path, ) for path in paths))
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+
+
+class CapacityTracker:
+    # free space is read from the disk at most once per interval, bytes still owed to busy files
+    # on any worker are reserved on top of it so concurrent workers do not over-commit a disk
+    # (busy files always carry a lease, so the sum reads iFileLease; +DestID keeps the planner
+    # off iFileDestID, which holds every file ever copied to the disk)
+    sqlinflight = '''select DestID, sum(FileSize - coalesce(CopyOffset, 0)) from TableFile
+        where LeaseExpiry is not null and CopyState=?'''
+
+    def __init__(self, database, interval = 30, reserve = pow(2, 30)):
+        self.database = database
+        self.interval = interval
+        self.reserve = reserve
+        self.free = {}
+
+    def refresh(self, dest):
+        try:
+            free = disk_usage(dest['DiskPath']).free
+        except OSError:
+            free = 0
+        self.free[dest['DestID']] = (free, time.monotonic())
+        return free
+
+    def invalidate(self, destid = None):
+        if destid is None:
+            self.free.clear()
+        else:
+            self.free.pop(destid, None)
+
+    def consume(self, destid, size):
+        if destid in self.free:
+            free, stamp = self.free[destid]
+            self.free[destid] = (free - size, stamp)
+
+    def getfree(self, dest):
+        cached = self.free.get(dest['DestID'])
+        if cached is None or time.monotonic() - cached[1] >= self.interval:
+            return self.refresh(dest)
+        return cached[0]
+
+    def getinflight(self, destid = None):
+        if destid is None:
+            return dict(self.database.query(self.sqlinflight + ' group by +DestID', (CopyState.busy, ), None))
+        row = self.database.queryone(self.sqlinflight + ' and +DestID=?', (CopyState.busy, destid), None)
+        return {destid: row[1] or 0}
+
+    def available(self, dest, inflight = None):
+        if inflight is None:
+            inflight = self.getinflight(dest['DestID'])
+        return self.getfree(dest) - self.reserve - (inflight.get(dest['DestID']) or 0)
+
+
 class TaskManager:
+    # a host or destination takes new streams until its busy tasks reach MaxStreams
+    hoststreams = '''(select count(*) from TableTask as Busy inner join TableDir as BusyDir
+        on Busy.DirID=BusyDir.DirID where BusyDir.HostID=TableHost.HostID and Busy.CopyState=%d)''' % CopyState.busy
+    deststreams = '''(select count(*) from TableTask as Busy
+        where Busy.DestID=TableDest.DestID and Busy.CopyState=%d)''' % CopyState.busy
+    hostopen = '''TableHost.ActiveState=%d and TableHost.CopyState in (%d, %d)
+        and %s < max(TableHost.MaxStreams, 1)''' % (ActiveState.active, CopyState.idle, CopyState.busy, hoststreams)
+    destopen = '''TableDest.ActiveState=%d and TableDest.CopyState in (%d, %d)
+        and %s < max(TableDest.MaxStreams, 1)''' % (ActiveState.active, CopyState.idle, CopyState.busy, deststreams)
+    # +HostID drives the count from the busy tasks rather than a walk of every dir in host order
+    hostload = '''left join (select BusyDir.HostID, count(*) as Streams from TableTask as Busy
+        inner join TableDir as BusyDir on Busy.DirID=BusyDir.DirID where Busy.CopyState=%d
+        group by +BusyDir.HostID) as HostLoad on HostLoad.HostID=TableHost.HostID''' % CopyState.busy
+    hostavailable = '''TableHost.ActiveState=%d and TableHost.CopyState in (%d, %d)
+        and coalesce(HostLoad.Streams, 0) < max(TableHost.MaxStreams, 1)''' % (ActiveState.active, CopyState.idle, CopyState.busy)
+    hostusage = 'coalesce(HostLoad.Streams, 0) * 1.0 / max(TableHost.MaxStreams, 1)'
+    # spelled out rather than bound, a partial index (iDirIdle) is only used when the
+    # planner can see the query matches its where clause
+    diridle = 'TableDir.ActiveState=%d and TableDir.CopyState=%d' % (ActiveState.active, CopyState.idle)
+    sqlfindtask = '''select Task.* from TableTask as Task 
+        inner join TableDest on Task.DestID=TableDest.DestID
+        inner join TableDir on Task.DirID=TableDir.DirID
+        inner join TableHost on TableDir.HostID=TableHost.HostID ''' + hostload + '''
+        where Task.CopyState=? and Task.DestID not in (select value from json_each(?))
+        and ''' + destopen + ' and ' + hostavailable + '''
+        order by ''' + hostusage + ' limit 1'
+    # a dir with an idle or busy task is already planned or being copied onto some disk
+    dirunplanned = '''not exists (select 1 from TableTask as Planned where Planned.DirID=TableDir.DirID
+        and Planned.CopyState in (%d, %d))''' % (CopyState.idle, CopyState.busy)
+    sqlfinddir = '''select TableDir.* from TableDir
+        inner join TableHost on TableDir.HostID=TableHost.HostID ''' + hostload + '''
+        where ''' + diridle + ' and ' + dirunplanned + ' and ' + hostavailable + '''
+        order by ''' + hostusage + ', TableDir.FilesSize desc limit 1'
+    sqlidledirs = 'select 1 from TableDir where ' + diridle + ' limit 1'
+    sqlexpired = '''select 1 where
+        exists (select 1 from TableTask where LeaseExpiry<? and CopyState=?)
+        or exists (select 1 from TableFile where LeaseExpiry<? and CopyState=?)'''
+
     def __init__(self, database):
         self.database = database
         self.connection = database.connection
@@ -627,13 +1311,25 @@ class TaskManager:
         self.tablefile = TableFile(database)
         self.tabledest = TableDest(database)
         self.tabletask = TableTask(database)
+        self.tablesnapshot = TableSnapshot(database)
+        self.tablepack = TablePack(database)
+        self.tables = (self.tablehost, self.tabledir, self.tablefile,
+                       self.tabledest, self.tabletask, self.tablesnapshot,
+                       self.tablepack)
+        self.workerid = metrics.workerid
+        self.leasetime = 60
+        self.capacity = CapacityTracker(database)
 
-    def updatecopystate(self, taskid, copystate):
-        self.database.begin()
+    def updatecopystate(self, taskid, copystate, workerid = None):
+        # with a workerid, a task whose lease was reclaimed and handed to another worker is left alone
+        self.database.begin('immediate')
         try:
             task = self.tabletask.gettask(taskid)
+            owned = workerid is None or task['WorkerID'] == workerid
             directory = self.tabledir.getdir(task['DirID'])
-            if copystate == CopyState.busy or copystate == CopyState.failed:
+            if not owned:
+                pass
+            elif copystate == CopyState.busy or copystate == CopyState.failed:
                 self.tabletask.updatecopystate(task['TaskID'], copystate)
                 self.tablehost.updatecopystate(task['DirID'], copystate)
                 self.tabledest.updatecopystate(task['DestID'], copystate)
@@ -641,8 +1337,9 @@ class TaskManager:
                     self.tabledir.updatecopystate(task['DirID'], copystate)            
             else:
                 self.tabletask.updatecopystate(task['TaskID'], copystate)
-                self.tablehost.updatecopystate(task['DirID'], CopyState.idle)               
-                self.tabledest.updatecopystate(task['DestID'], CopyState.idle)
+                self.tablehost.releasecopystate(task['DirID'])
+                self.tabledest.releasecopystate(task['DestID'])
+                self.database.notify()
                 if directory['CopyState'] != CopyState.finished:
                     self.tabledir.updatecopystate(task['DirID'], copystate)            
         except:
@@ -650,70 +1347,228 @@ class TaskManager:
             raise
         else:   
             self.database.commit()
+            return owned
             
     def getdestmax(self):
-        self.database.begin()
+        dests = self.database.query('select * from TableDest where ' + self.destopen)
+        inflight = self.capacity.getinflight() if dests else {}
+        dest = None
+        freeusage = 0
+        for row in dests:
+            available = self.capacity.available(row, inflight)
+            if available > freeusage:
+                freeusage = available
+                dest = row
+        return dest
+
+    def findtask(self):
+        return self.database.queryone(self.sqlfindtask, (CopyState.idle, json.dumps(self.unreachabledests())))
+
+    def getstreams(self, hostid, destid):
+        # tasks busy on the host and on the disk, this worker's own included
+        return tuple(self.database.queryone('select ' + self.hoststreams + ', ' + self.deststreams + '''
+            from TableHost, TableDest where TableHost.HostID=? and TableDest.DestID=?''', (hostid, destid), None)
+            or (1, 1))
+
+    def unreachabledests(self):
+        # plantasks places tasks by DiskCapacity on disks that are not mounted yet,
+        # they are handed out once the disk is back
+        return [dest['DestID'] for dest in self.database.query('select DestID, DiskPath from TableDest where ActiveState=?',
+                                                               (ActiveState.active, ))
+                if not os.path.isdir(dest['DiskPath'])]
+
+    def finddir(self):
+        return self.database.queryone(self.sqlfinddir)
+
+    def hasidledirs(self):
+        return None != self.database.queryone(self.sqlidledirs)
+
+    def claimtask(self, taskid):
+        dest = self.database.queryone('''select TableDest.DiskPath from TableTask
+                inner join TableDest on TableTask.DestID=TableDest.DestID where TaskID=?''', (taskid, ))
+        if not dest or not os.path.isdir(dest['DiskPath']):
+            return False
+        self.database.begin('immediate')
         try:
-            dest = None
-            freeusage = 0
-            for row in self.cursor.execute('''select * from TableDest
-                                     where ActiveState=? and CopyState=? ''',
-                                     (ActiveState.active, CopyState.idle)):
-                usage = disk_usage(row['DiskPath'])
-                if usage.free > freeusage:
-                    freeusage = usage.free  
-                    dest = row    
+            self.cursor.execute('''update TableTask set CopyState=?, WorkerID=?, LeaseExpiry=?
+                    where TaskID=? and CopyState=? and exists
+                    (select 1 from TableDest, TableDir, TableHost
+                    where TableDest.DestID=TableTask.DestID and TableDir.DirID=TableTask.DirID
+                    and TableDir.CopyState=? and TableHost.HostID=TableDir.HostID
+                    and ''' + self.destopen + ' and ' + self.hostopen + ')',
+                    (CopyState.busy, self.workerid, self.leaseexpiry(), taskid, CopyState.idle, CopyState.idle))
+            claimed = self.cursor.rowcount == 1
+            if claimed:
+                self.updatecopystate(taskid, CopyState.busy)
         except:
             self.database.rollback()
             raise
-        else:   
+        else:
             self.database.commit()
-            return dest    	
+            return claimed
 
-    def requesttask(self):           
+    def createtask(self, destid, dirid):
         self.database.begin('immediate')
         try:
-            task = self.cursor.execute('''select Task.* from TableTask as Task 
-                    inner join TableDest on Task.DestID=TableDest.DestID
-                    inner join TableDir on Task.DirID=TableDir.DirID
+            taskid = None
+            row = fetchfirst(self.cursor.execute('''select 1 from TableDest, TableDir
                     inner join TableHost on TableDir.HostID=TableHost.HostID
-                    where Task.CopyState=? 
-                    and TableDest.ActiveState=? and TableDest.CopyState=? 
-                    and TableHost.ActiveState=? and TableHost.CopyState=?''', 
-                    (CopyState.idle, ActiveState.active, CopyState.idle, 
-                    ActiveState.active, CopyState.idle)).fetchone()
-
-            if not task:
-                dest = self.getdestmax()
-                if dest:     
-##                    freeusage = shutil.disk_usage(dest['DiskPath']).free -  pow(2, 30)
-##                    if freeusage < 0:
-##                        freeusage = 0
-                    directory = self.cursor.execute('''select * from TableDir
-                        inner join TableHost on TableDir.HostID=TableHost.HostID
-                        where TableDir.ActiveState=? and TableDir.CopyState=? 
-                        and TableHost.ActiveState=? and TableHost.CopyState=?
-                        order by TableDir.FilesSize desc''',
-                        (ActiveState.active, CopyState.idle, 
-                         ActiveState.active, CopyState.idle)).fetchone()
-                    if directory:
-                        self.cursor.execute('''insert into TableTask(DestID, DirID)
-                            Values(?, ?) ''', 
-                            (dest['DestID'], directory['DirID']))
-                        task = self.cursor.execute('''select * from TableTask where DestID=? and DirID=?''',
-                                              (dest['DestID'], directory['DirID'])).fetchone()
-                    else:
-                        self.tabledest.updatecopystate(dest['DestID'], CopyState.finished) 
-            if task:
-                self.updatecopystate(task['TaskID'], CopyState.busy)
-                task = self.tabletask.gettask(task['TaskID'])
+                    where TableDest.DestID=? and TableDir.DirID=?
+                    and TableDir.ActiveState=? and TableDir.CopyState=?
+                    and ''' + self.dirunplanned + ' and ' + self.destopen + ' and ' + self.hostopen,
+                    (destid, dirid, ActiveState.active, CopyState.idle)))
+            if row:
+                self.cursor.execute('''insert into TableTask(DestID, DirID, WorkerID, LeaseExpiry)
+                    Values(?, ?, ?, ?) ''', (destid, dirid, self.workerid, self.leaseexpiry()))
+                taskid = self.cursor.lastrowid
+                self.updatecopystate(taskid, CopyState.busy)
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+            return taskid
+
+    def leaseexpiry(self):
+        return int(time.time()) + self.leasetime
+
+    def renewleases(self, dirid):
+        # False once the task on dirid is no longer this worker's, its lease lapsed and was reclaimed
+        self.database.begin('immediate')
+        try:
+            expiry = self.leaseexpiry()
+            self.cursor.execute('''update TableTask set LeaseExpiry=? where DirID=? and WorkerID=? and CopyState=?''',
+                                (expiry, dirid, self.workerid, CopyState.busy))
+            owned = self.cursor.rowcount > 0
+            if owned:
+                self.cursor.execute('''update TableFile set LeaseExpiry=? where DirID=? and WorkerID=? and CopyState=?
+                                    and LeaseExpiry is not null''',
+                                    (expiry, dirid, self.workerid, CopyState.busy))
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+            return owned
+
+    def reclaimexpired(self):
+        now = int(time.time())
+        if not self.database.queryone(self.sqlexpired, (now, CopyState.busy, now, CopyState.busy)):
+            return 0
+        self.database.begin('immediate')
+        try:
+            tasks = self.cursor.execute('''select TaskID from TableTask where LeaseExpiry<? and CopyState=?''',
+                                        (now, CopyState.busy)).fetchall()
+            for task in tasks:
+                self.updatecopystate(task['TaskID'], CopyState.idle)
+            self.cursor.execute('''update TableFile set CopyState=?, WorkerID=NULL, LeaseExpiry=NULL
+                                where LeaseExpiry<? and CopyState=?''', (CopyState.idle, now, CopyState.busy))
+            reclaimed = len(tasks) + self.cursor.rowcount
+            self.database.notify()
         except:
-            self.database.rollback();
+            self.database.rollback()
             raise
         else:
             self.database.commit()
-            return task       
+            return reclaimed
+
+    def requesttask(self, attempts = 5):
+        self.reclaimexpired()
+        for attempt in range(attempts):
+            task = self.findtask()
+            if task:
+                if self.claimtask(task['TaskID']):
+                    return self.tabletask.gettask(task['TaskID'])
+                continue
+            dest = self.getdestmax()
+            if not dest:
+                return None
+            directory = self.finddir()
+            if not directory:
+                # every source host may just be at its stream limit
+                if not self.hasidledirs():
+                    self.tabledest.updatecopystate(dest['DestID'], CopyState.finished) 
+                return None
+            taskid = self.createtask(dest['DestID'], directory['DirID'])
+            if taskid:
+                return self.tabletask.gettask(taskid)
+        return None
     
+    def plantasks(self, dryrun = False, reserve = pow(2, 30)):
+        self.database.begin('immediate')
+        try:
+            dirs = self.cursor.execute('''select TableDir.DirID, TableDir.FilesSize from TableDir
+                inner join TableHost on TableDir.HostID=TableHost.HostID
+                where TableDir.ActiveState=? and TableDir.CopyState=?
+                and TableHost.ActiveState=? and TableDir.FilesSize>0
+                and not exists (select 1 from TableTask where TableTask.DirID=TableDir.DirID
+                and TableTask.CopyState in (?, ?))
+                order by TableDir.FilesSize desc''',
+                (ActiveState.active, CopyState.idle, ActiveState.active,
+                 CopyState.idle, CopyState.busy)).fetchall()
+            dests = self.cursor.execute('''select * from TableDest
+                where ActiveState=? and CopyState in (?, ?)''',
+                (ActiveState.active, CopyState.idle, CopyState.busy)).fetchall()
+            planned = dict(self.cursor.execute('''select Task.DestID, sum(TableDir.FilesSize)
+                from TableTask as Task inner join TableDir on Task.DirID=TableDir.DirID
+                where Task.CopyState in (?, ?) group by Task.DestID''',
+                (CopyState.idle, CopyState.busy)).fetchall())
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+
+        capacity = {}
+        remaining = {}
+        for dest in dests:
+            try:
+                usage = disk_usage(dest['DiskPath'])
+                capacity[dest['DestID']] = usage.total
+                free = usage.free
+            except OSError:
+                capacity[dest['DestID']] = dest['DiskCapacity'] or 0
+                free = capacity[dest['DestID']]
+            remaining[dest['DestID']] = free - reserve - (planned.get(dest['DestID']) or 0)
+
+        tasks = []
+        unplaced = []
+        for directory in dirs:
+            fits = [destid for destid in remaining if remaining[destid] >= directory['FilesSize']]
+            if fits:
+                destid = min(fits, key=lambda destid: remaining[destid])
+                remaining[destid] -= directory['FilesSize']
+                tasks.append((destid, directory['DirID']))
+            else:
+                unplaced.append(directory['DirID'])
+
+        print('DestID,DiskSN,Capacity,Planned,NewTasks,Fill')
+        for dest in dests:
+            destid = dest['DestID']
+            used = capacity[destid] - remaining[destid] - reserve
+            fill = used / capacity[destid] * 100 if capacity[destid] else 0
+            print('%s,%s,%d,%d,%d,%.1f%%' % (destid, dest['DiskSN'], capacity[destid], used,
+                  sum(1 for task in tasks if task[0] == destid), fill))
+        if unplaced:
+            print('%d directories do not fit on any destination' % len(unplaced))
+
+        if not dryrun:
+            self.database.begin('immediate')
+            try:
+                # the plan was read in an earlier transaction, skip dirs another worker took meanwhile
+                self.cursor.executemany('''insert into TableTask(DestID, DirID) select ?, ?
+                    where not exists (select 1 from TableTask where DirID=? and CopyState in (?, ?))
+                    and exists (select 1 from TableDir where DirID=? and CopyState=?)''',
+                    ((destid, dirid, dirid, CopyState.idle, CopyState.busy, dirid, CopyState.idle)
+                     for destid, dirid in tasks))
+                self.database.notify()
+            except:
+                self.database.rollback()
+                raise
+            else:
+                self.database.commit()
+        return tasks, unplaced
+
     def _zerocopystate(self):
         self.database.begin('exclusive')
         try:
@@ -728,18 +1583,37 @@ class TaskManager:
         else:   
             self.database.commit()
                         
+    def upgrade_database(self):
+        for table in self.tables:
+            table.create()
+        if not self.database.analyzed():
+            self.database.analyze()
+
     def build_database(self):
-        self.tablehost.create()
-        self.tabledir.create()
-        self.tablefile.create()
-        self.tabledest.create()       
-        self.tabletask.create()
+        self.upgrade_database()
         self.database.begin('exclusive')
         try:
             self.tablehost.append('./dictionary/StorageHost.csv')
             self.tabledir.append('./dictionary/StorageDir.csv')
             self.tablefile.append('./dictionary/StorageFile.csv')
             self.tabledest.append('./dictionary/Destination.csv')
+            self.database.notify()
+        except:
+            self.database.rollback()
+            raise
+        else:
+            self.database.commit()
+            self.database.analyze()
+
+    def applydeltas(self, deltas, hostid = None, snapshots = (), removed = ()):
+        # the snapshots go in with the deltas, if the apply fails the next scan sees the dirs again
+        self.database.begin('immediate')
+        try:
+            self.tabledir.applydeltas(deltas, hostid)
+            self.tablefile.applydeltas(deltas)
+            self.tablesnapshot.removesnapshots(removed)
+            self.tablesnapshot.savesnapshots(snapshots)
+            self.database.notify()
         except:
             self.database.rollback()
             raise
@@ -760,7 +1634,7 @@ class TaskManager:
             self.database.commit()
 
     def activatetask(self, taskid, activestate):
-        self.database.begin()
+        self.database.begin('immediate')
         try:
             task = self.tabletask.gettask(taskid)
             self.tabledest.activate(task['DestID'], activestate)
@@ -0,0 +1,74 @@
+import sys, argparse, checksum, database
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from pathlib import PurePath
+
+hashworkers = 8
+
+def getfilepath(file):
+    return str(PurePath(file['Location']).joinpath(file['FileName'] + file['ExtName']))
+
+def group(executor, files, key):
+    def safekey(file):
+        try:
+            return key(file)
+        except OSError as why:
+            print(why, file=sys.stderr)
+            return None
+
+    groups = {}
+    for file, value in zip(files, executor.map(safekey, files)):
+        if value is not None:
+            groups.setdefault(value, []).append(file)
+    return [files for files in groups.values() if len(files) > 1]
+
+def isduplicateentry(file):
+    # recorded finished as a link to a copy on another disk, it holds no data of its own
+    return (file['CopyState'] == database.CopyState.finished and file['DupOf']
+            and (file['CopyStatus'] or '').startswith('Duplicate of'))
+
+def findduplicates(manager, algo):
+    hashes = []
+    duplicates = []
+
+    def fullhash(file):
+        if file['HashAlgo'] == algo and file['FileHash']:
+            return file['FileHash']
+        filehash = checksum.hashfile(getfilepath(file), algo)
+        hashes.append((algo, filehash, file['FileID']))
+        return filehash
+
+    with ThreadPoolExecutor(max_workers=hashworkers) as executor:
+        for size, files in groupby(manager.tablefile.getsizegroups(), key=lambda file: file['FileSize']):
+            files = list(files)
+            for candidates in group(executor, files, lambda file: checksum.partialhash(getfilepath(file), algo)):
+                for same in group(executor, candidates, fullhash):
+                    entries = [file for file in same if isduplicateentry(file)]
+                    copies = [file for file in same if not isduplicateentry(file)]
+                    primary = min(copies, key=lambda file: (file['CopyState'] != database.CopyState.finished,
+                                                            file['FileID']), default=None)
+                    if entries and (primary is None or primary['CopyState'] != database.CopyState.finished):
+                        primaryid = entries[0]['DupOf']
+                    else:
+                        primaryid = primary['FileID']
+                    duplicates.extend((primaryid, file['FileID']) for file in copies if file['FileID'] != primaryid)
+    manager.tablefile.updatehashes(hashes)
+    manager.tablefile.setduplicates(duplicates)
+    return duplicates
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--algo', default='blake2b')
+    args = parser.parse_args()
+
+    manager = database.TaskManager(database.Database())
+    manager.upgrade_database()
+    duplicates = findduplicates(manager, args.algo)
+    print('PrimaryID,FileID')
+    for primaryid, fileid in duplicates:
+        print(str(primaryid) + ',' + str(fileid))
+
+
+if __name__=='__main__':
+    main()
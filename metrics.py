@@ -0,0 +1,99 @@
+import os, time, socket, threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+workerid = socket.gethostname() + ':' + str(os.getpid())
+buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(buckets), 0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set(key[0] for key in values)):
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    for key in sorted(key for key in values if key[0] == name):
+                        lines.append('%s%s %s' % (name, formatlabels(key[1]), values[key]))
+            for name in sorted(set(key[0] for key in self.histograms)):
+                lines.append('# TYPE %s histogram' % name)
+                for key in sorted(key for key in self.histograms if key[0] == name):
+                    counts, total, count = self.histograms[key]
+                    for bound, bucketcount in zip(buckets, counts):
+                        lines.append('%s_bucket%s %d' % (name, formatlabels(key[1] + (('le', bound), )), bucketcount))
+                    lines.append('%s_bucket%s %d' % (name, formatlabels(key[1] + (('le', '+Inf'), )), count))
+                    lines.append('%s_sum%s %s' % (name, formatlabels(key[1]), total))
+                    lines.append('%s_count%s %d' % (name, formatlabels(key[1]), count))
+        return '\n'.join(lines) + '\n'
+
+    def writefile(self, path):
+        temppath = path + '.tmp'
+        with open(temppath, 'w') as outfile:
+            outfile.write(self.render())
+        os.replace(temppath, path)
+
+    def startflusher(self, path, interval = 15):
+        def flush():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.writefile(path)
+                except OSError as why:
+                    print(why)
+        thread = threading.Thread(target=flush, daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self, port, address = '127.0.0.1'):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+def formatlabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+registry = Metrics()
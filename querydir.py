@@ -1,5 +1,6 @@
 
-import csv, sys, io, platform
+import csv, sys, io, os, stat, platform, argparse, database
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 from datetime import date
 
@@ -24,18 +25,24 @@ def output(text):
             text = bytes.decode(sys.stdout.encoding, 'strict')
             sys.stdout.write(text)
 
+scanworkers = 8
+
 class PathInfo():
-    def __init__(self, path):
+    def __init__(self, path, pathstat, parent = None):
         self.path = path    
+        self.ctime = pathstat.st_ctime
+        self.mtime = pathstat.st_mtime
         self.size = 0
         self.filenum = 0
         self.dirnum = 0
         self.maxlayer = 0
+        self.parent = parent
+        self.pending = 0
 
     def __str__(self):
         dateformat='%Y/%m/%d'
-        ctime=date.fromtimestamp(self.path.stat().st_ctime).strftime(dateformat)
-        utime=date.fromtimestamp(self.path.stat().st_mtime).strftime(dateformat)
+        ctime=date.fromtimestamp(self.ctime).strftime(dateformat)
+        utime=date.fromtimestamp(self.mtime).strftime(dateformat)
         result = ','.join([str(self.path.parent),
                          self.path.stem,
                          self.path.suffix,
@@ -48,48 +55,223 @@ class PathInfo():
         result += '\n'
         return result
 
-def query_path(path):  
-    result = PathInfo(path)
-    if path.is_dir():
-        for child in path.iterdir():
-##            if isHidenFile(child):
-##                continue
-            pathinfo = query_path(child)
-            result.size += pathinfo.size
-            result.dirnum += pathinfo.dirnum
-            result.filenum += pathinfo.filenum
-            if child.is_dir():
-                result.dirnum += 1
-            else:
-                result.filenum += 1
-            if result.maxlayer < pathinfo.maxlayer:
-                result.maxlayer = pathinfo.maxlayer
-        result.maxlayer += 1
-    else:
-        result.size = path.stat().st_size
-
-    output(result)
-        
-    return result       
+def listdir(path):
+    entries = []
+    try:
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+##                if isHidenFile(entry.path):
+##                    continue
+                try:
+                    entries.append((entry.path, entry.is_dir(), entry.stat()))
+                except OSError as why:
+                    print(why, file=sys.stderr)
+    except OSError as why:
+        print(why, file=sys.stderr)
+    return entries
+
+def scan_path(path, workers = None):
+    pathstat = path.stat()
+    root = PathInfo(path, pathstat)
+    if not stat.S_ISDIR(pathstat.st_mode):
+        root.size = pathstat.st_size
+        yield root
+        return
+
+    with ThreadPoolExecutor(max_workers=workers or scanworkers) as executor:
+        futures = {executor.submit(listdir, path): root}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = futures.pop(future)
+                for childpath, isdir, childstat in future.result():
+                    child = PathInfo(Path(childpath), childstat, node)
+                    if isdir:
+                        node.dirnum += 1
+                        node.pending += 1
+                        futures[executor.submit(listdir, childpath)] = child
+                    else:
+                        child.size = childstat.st_size
+                        node.filenum += 1
+                        node.size += child.size
+                        yield child
+                while node and node.pending == 0:
+                    node.maxlayer += 1
+                    yield node
+                    parent = node.parent
+                    if parent:
+                        parent.size += node.size
+                        parent.dirnum += node.dirnum
+                        parent.filenum += node.filenum
+                        if parent.maxlayer < node.maxlayer:
+                            parent.maxlayer = node.maxlayer
+                        parent.pending -= 1
+                    node = parent
     
+def probe(path, snapshot):
+    pathstat = os.stat(path)
+    if snapshot and snapshot['MTime'] == pathstat.st_mtime_ns:
+        return pathstat, None
+    return pathstat, listdir(path)
+
+def scan_changes(path, manager, snapshots, removed, workers = None):
+    tablesnapshot = manager.tablesnapshot
+    tabledir = manager.tabledir
+    tablefile = manager.tablefile
+    with ThreadPoolExecutor(max_workers=workers or scanworkers) as executor:
+        path = str(path)
+        snapshot = tablesnapshot.getsnapshot(path)
+        futures = {executor.submit(probe, path, snapshot): (path, snapshot)}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirpath, snapshot = futures.pop(future)
+                try:
+                    pathstat, entries = future.result()
+                except OSError as why:
+                    print(why, file=sys.stderr)
+                    continue
+                subdirs = tablesnapshot.getchildren(dirpath)
+                if entries is not None:
+                    dirid = tabledir.getdirid(dirpath)
+                    known = {file['FileName'] + file['ExtName']: file
+                             for file in tablefile.getfilesof(dirid)}
+                    # in an active dir an inactive file was removed before, elsewhere nothing is active yet
+                    directory = tabledir.getdir(dirid) if dirid else None
+                    dirinactive = not directory or directory['ActiveState'] != database.ActiveState.active
+                    previous = set(subdirs)
+                    subdirs = []
+                    totalsize = 0
+                    for childpath, isdir, childstat in entries:
+                        name = os.path.basename(childpath)
+                        if isdir:
+                            subdirs.append(childpath)
+                            continue
+                        totalsize += childstat.st_size
+                        file = known.pop(name, None)
+                        if file is None:
+                            yield ('added', 'file', dirpath, name, childstat.st_size)
+                        elif file['ActiveState'] != database.ActiveState.active and not dirinactive:
+                            yield ('added', 'file', dirpath, name, childstat.st_size)
+                        elif file['FileSize'] != childstat.st_size:
+                            yield ('modified', 'file', dirpath, name, childstat.st_size)
+                    if snapshot is None and not tabledir.getdirid(dirpath):
+                        p = Path(dirpath)
+                        yield ('added', 'dir', str(p.parent), p.name, totalsize)
+                    for name in known:
+                        if known[name]['ActiveState'] == database.ActiveState.active or dirinactive:
+                            yield ('removed', 'file', dirpath, name, known[name]['FileSize'])
+                    for gone in previous.difference(subdirs):
+                        yield from scan_removed(gone, manager, removed)
+                    snapshots.append((dirpath, str(Path(dirpath).parent), pathstat.st_mtime_ns,
+                                      len(entries), totalsize))
+                for subdir in subdirs:
+                    snapshot = tablesnapshot.getsnapshot(subdir)
+                    futures[executor.submit(probe, subdir, snapshot)] = (subdir, snapshot)
+
+def scan_removed(dirpath, manager, removed):
+    pending = [dirpath]
+    while pending:
+        dirpath = pending.pop()
+        dirid = manager.tabledir.getdirid(dirpath)
+        directory = manager.tabledir.getdir(dirid) if dirid else None
+        dirinactive = not directory or directory['ActiveState'] != database.ActiveState.active
+        for file in manager.tablefile.getfilesof(dirid):
+            if file['ActiveState'] == database.ActiveState.active or dirinactive:
+                yield ('removed', 'file', dirpath, file['FileName'] + file['ExtName'], file['FileSize'])
+        p = Path(dirpath)
+        yield ('removed', 'dir', str(p.parent), p.name, 0)
+        removed.append(dirpath)
+        pending.extend(manager.tablesnapshot.getchildren(dirpath))
+
+def ingest_path(path, manager, hostid, export = None, batchsize = 50000):
+    tabledir = manager.tabledir
+    tablefile = manager.tablefile
+    dirids = tabledir.getdirids()
+    existing = set(dirids.values())
+    dirid = tabledir.maxid('DirID')
+    fileid = tablefile.maxid('FileID')
+    filessizes = {}
+    dirs = []
+    files = []
+    tablefile.createstage()
+    for pathinfo in scan_path(path):
+        if export:
+            export.write(str(pathinfo))
+        p = pathinfo.path
+        if pathinfo.maxlayer:
+            key = (p.name, str(p.parent))
+        else:
+            key = (p.parent.name, str(p.parent.parent))
+        if key not in dirids:
+            dirid += 1
+            dirids[key] = dirid
+        if pathinfo.maxlayer:
+            if dirids[key] not in existing:
+                dirs.append((dirids[key], p.name, pathinfo.size, str(p.parent), hostid,
+                             filessizes.pop(dirids[key], 0)))
+        else:
+            fileid += 1
+            files.append((fileid, p.stem, p.suffix, pathinfo.size, str(p.parent), dirids[key]))
+            filessizes[dirids[key]] = filessizes.get(dirids[key], 0) + pathinfo.size
+        if len(files) + len(dirs) >= batchsize:
+            tabledir.insertdirs(dirs)
+            tablefile.stage(files)
+            dirs = []
+            files = []
+    tabledir.insertdirs(dirs)
+    tablefile.stage(files)
+    return tablefile.loadstage()
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infilename', nargs='?')
+    parser.add_argument('-i', '--incremental', action='store_true')
+    parser.add_argument('-d', '--database', action='store_true')
+    parser.add_argument('-o', '--csv')
+    args = parser.parse_args()
 ##    infilename = 'locations_resources.csv'
-    if len(sys.argv)<=1:
+    if not args.infilename:
         print('请提供需要检索的文件夹路径', file=sys.stderr)
         return
     
-    infilename = sys.argv[1]
+    infilename = args.infilename
 
-    print('Location,FileName,ExtName,CreateTime,UpdateTime,Size,FileNum,DirNum,MaxLayer')
+    header = 'Location,FileName,ExtName,CreateTime,UpdateTime,Size,FileNum,DirNum,MaxLayer'
+    export = None
+    if args.incremental or args.database:
+        manager = database.TaskManager(database.Database())
+        manager.upgrade_database()
+        if args.csv:
+            export = open(args.csv, 'w', encoding='utf-8')
+            export.write(header + '\n')
+    if args.incremental:
+        print('Delta,Type,Location,Name,Size')
+    elif not args.database:
+        print(header)
     with open(infilename, newline='') as infile:
         reader=csv.DictReader(infile)
         for row in reader:
             path=Path(row['Location'])
-            query_path(path)
+            if args.incremental:
+                deltas = []
+                snapshots = []
+                removed = []
+                for delta in scan_changes(path, manager, snapshots, removed):
+                    output(','.join(str(value) for value in delta) + '\n')
+                    deltas.append(delta)
+                manager.applydeltas(deltas, row.get('HostID'), snapshots, removed)
+            elif args.database:
+                if row.get('HostID'):
+                    manager.tablehost.addhost(row['HostID'], row.get('HostAddr'))
+                inserted = ingest_path(path, manager, row.get('HostID'), export)
+                print(row['Location'] + ': ' + str(inserted) + ' files', file=sys.stderr)
+            else:
+                for pathinfo in scan_path(path):
+                    output(pathinfo)
+    if export:
+        export.close()
 
 
 if __name__=='__main__':
     main()
-
-    
-    
@@ -0,0 +1,106 @@
+import os, sys, shutil, argparse, database
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import PurePath
+
+restoreworkers = 2
+
+def getrestorepath(target, file):
+    location = PurePath(file['Location'])
+    return str(PurePath(target).joinpath(*location.parts[1:], file['FileName'] + file['ExtName']))
+
+def getsource(manager, file):
+    if file['DupOf'] and (file['CopyStatus'] or '').startswith('Duplicate of'):
+        primary = manager.tablefile.getfile(file['DupOf'])
+        if primary and primary['CopyState'] == database.CopyState.finished:
+            file = primary
+    pack = manager.tablepack.getpack(file['FileID'])
+    if pack:
+        return pack['DestID'], pack['Container'], pack['Offset']
+    directory = manager.tabledir.getdir(file['DirID'])
+    return file['DestID'], str(PurePath(directory['DirName']).joinpath(file['FileName'] + file['ExtName'])), None
+
+def restorefile(diskpath, source, offset, size, restorepath):
+    print(restorepath)
+    os.makedirs(os.path.dirname(restorepath), exist_ok=True)
+    sourcepath = os.path.join(diskpath, source)
+    if offset is None:
+        shutil.copy2(sourcepath, restorepath)
+        return
+    with open(sourcepath, 'rb') as container, open(restorepath, 'wb') as outfile:
+        container.seek(offset)
+        while size > 0:
+            data = container.read(min(size, 8 * pow(2, 20)))
+            if not data:
+                raise OSError('Truncated container ' + sourcepath)
+            outfile.write(data)
+            size -= len(data)
+
+def diskorder(diskpath, request):
+    source, offset = request[1], request[2]
+    if offset is not None:
+        return (source, offset)
+    try:
+        return ('', os.stat(os.path.join(diskpath, source)).st_ino)
+    except OSError:
+        return ('', 0)
+
+def waitfordisk(dest, wait):
+    while not os.path.exists(dest['DiskPath']):
+        if not wait:
+            return False
+        prompt = 'Mount disk %s (%s, batch %s) at %s and press Enter, or type skip: ' % (
+            dest['DestID'], dest['DiskSN'], dest['DiskBatch'], dest['DiskPath'])
+        if input(prompt).strip().lower() == 'skip':
+            return False
+    return True
+
+def restore(manager, files, target, wait = True, workers = None):
+    requests = {}
+    for file in files:
+        destid, source, offset = getsource(manager, file)
+        requests.setdefault(destid, []).append((file, source, offset))
+
+    failed = []
+    for destid in sorted(requests, key=lambda destid: destid or 0):
+        dest = manager.tabledest.getdest(destid)
+        if not dest or not waitfordisk(dest, wait):
+            failed.extend(file for file, source, offset in requests[destid])
+            continue
+        ordered = sorted(requests[destid], key=lambda request: diskorder(dest['DiskPath'], request))
+        with ThreadPoolExecutor(max_workers=workers or restoreworkers) as executor:
+            futures = {executor.submit(restorefile, dest['DiskPath'], source, offset, file['FileSize'],
+                                       getrestorepath(target, file)): file
+                       for file, source, offset in ordered}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except OSError as why:
+                    print(why, file=sys.stderr)
+                    failed.append(futures[future])
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-d', '--dirid', type=int, action='append', default=[])
+    parser.add_argument('-t', '--target', required=True)
+    parser.add_argument('-w', '--workers', type=int)
+    parser.add_argument('--no-wait', action='store_true')
+    args = parser.parse_args()
+
+    manager = database.TaskManager(database.Database())
+    manager.upgrade_database()
+    files = {}
+    for dirid in args.dirid:
+        files.update((file['FileID'], file) for file in manager.tablefile.getcopied(dirid=dirid))
+    for path in args.paths:
+        p = PurePath(path)
+        files.update((file['FileID'], file) for file in
+                     manager.tablefile.getcopied(location=str(p.parent), name=p.name))
+    failed = restore(manager, files.values(), args.target, not args.no_wait, args.workers)
+    print('%d files restored, %d failed' % (len(files) - len(failed), len(failed)), file=sys.stderr)
+
+
+if __name__=='__main__':
+    main()
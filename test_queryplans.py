@@ -0,0 +1,79 @@
+import os, shutil, tempfile, unittest, database
+from database import ActiveState, CopyState, CapacityTracker, TableFile, TaskManager
+
+# the catalogs of hosts and disks, and the list of unmounted disks, stay small enough to scan
+smalltables = ('TableHost', 'TableDest', 'HostLoad', 'CONSTANT', 'json_each')
+
+def hotqueries():
+    return (('claimfiles', TableFile.sqlclaimfiles,
+             (0, CopyState.idle, ActiveState.active, 0, ActiveState.active, 1)),
+            ('getfilefrom', TableFile.sqlfilefrom,
+             (0, CopyState.idle, ActiveState.active, 0, ActiveState.active)),
+            ('countidle', TableFile.sqlcountidle, (0, CopyState.idle, ActiveState.active)),
+            ('countunordered', TableFile.sqlcountunordered, (0, CopyState.idle)),
+            ('findtask', TaskManager.sqlfindtask, (CopyState.idle, '[2]')),
+            ('finddir', TaskManager.sqlfinddir, ()),
+            ('hasidledirs', TaskManager.sqlidledirs, ()),
+            ('reclaimexpired', TaskManager.sqlexpired, (0, CopyState.busy, 0, CopyState.busy)),
+            ('getinflight', CapacityTracker.sqlinflight + ' group by +DestID', (CopyState.busy, )),
+            ('available', CapacityTracker.sqlinflight + ' and +DestID=?', (CopyState.busy, 0)))
+
+def fullscans(manager):
+    # returns (query, plan) for every hot scheduler query that scans TableFile, TableDir
+    # or TableTask (a full index scan included) instead of searching an index;
+    # a scan of a partial index only reads its subset
+    partial = set(row[0] for row in manager.database.query('''select name from sqlite_master
+        where type='index' and sql like '% where %' '''))
+    scans = []
+    for name, sql, params in hotqueries():
+        for row in manager.database.query('explain query plan ' + sql, params):
+            words = row['detail'].split()
+            if words[0] == 'SCAN' and words[1] not in smalltables and not partial.intersection(words):
+                scans.append((name, row['detail']))
+    return scans
+
+def buildcatalog(path, hosts = 2, dests = 2, dirs = 50, files = 5000):
+    manager = TaskManager(database.Database(path))
+    manager.upgrade_database()
+    connection = manager.connection
+    connection.executemany('insert into TableHost(HostID, HostAddr, ActiveState) values(?, ?, ?)',
+                           [(hostid, 'host%d' % hostid, ActiveState.active) for hostid in range(1, hosts + 1)])
+    connection.executemany('''insert into TableDest(DestID, DiskSN, DiskBatch, DiskPath, ActiveState)
+                           values(?, ?, ?, ?, ?)''',
+                           [(destid, 'sn%d' % destid, 'b1', 'dest%d' % destid, ActiveState.active)
+                            for destid in range(1, dests + 1)])
+    connection.executemany('''insert into TableDir(DirID, DirName, Location, HostID, ActiveState)
+                           values(?, ?, ?, ?, ?)''',
+                           [(dirid, 'dir%d' % dirid, 'src', dirid % hosts + 1, ActiveState.active)
+                            for dirid in range(1, dirs + 1)])
+    connection.executemany('''insert into TableFile(FileID, FileName, ExtName, FileSize, Location,
+                           DirID, ActiveState, CopyState) values(?, ?, ?, ?, ?, ?, ?, ?)''',
+                           [(fileid, 'f%d' % fileid, '.bin', fileid * 37 % 100000, 'src/dir%d' % (fileid % dirs + 1),
+                             fileid % dirs + 1, ActiveState.active,
+                             CopyState.finished if fileid % 3 else CopyState.idle)
+                            for fileid in range(1, files + 1)])
+    connection.executemany('insert into TableTask(DestID, DirID, CopyState) values(?, ?, ?)',
+                           [(dirid % dests + 1, dirid, CopyState.finished if dirid % 2 else CopyState.busy)
+                            for dirid in range(1, dirs // 2)])
+    connection.execute('update TableDir set CopyState=(select CopyState from TableTask where DirID=TableDir.DirID) '
+                       'where DirID in (select DirID from TableTask)')
+    connection.commit()
+    manager.database.analyze()
+    return manager
+
+
+class QueryPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='offlinebackup-plans-')
+        self.manager = buildcatalog(os.path.join(self.root, 'catalog.db'))
+
+    def tearDown(self):
+        self.manager.connection.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_hotqueries_search_an_index(self):
+        self.assertEqual(fullscans(self.manager), [])
+
+
+if __name__=='__main__':
+    unittest.main()